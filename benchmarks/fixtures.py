@@ -0,0 +1,177 @@
+"""
+Synthetic game files matching what the parsers expect, no game assets are needed
+
+MPK archives, P8 GXT textures, lay/png pairs and mvl/png pairs, built from a random seed.
+"""
+import io
+import random
+import struct
+import zlib
+
+from PIL import Image
+
+
+def make_mpk(members: list[tuple[str, bytes]], align: int = 0x800) -> bytes:
+    """
+    Make a mpk archive
+
+    :param members: list of (name, content)
+    :param align: alignment of the member offsets
+
+    :return: mpk data
+    """
+    header_size = 0x40 + 0x100 * len(members)
+    offset = (header_size + align - 1) // align * align
+
+    table = []
+    body = [bytes(offset - header_size)]
+    for i, (name, data) in enumerate(members):
+        table.append(struct.pack("?I3Q224s", False, i, offset, len(data), len(data), name.encode("shift_jis")))
+        body.append(data + bytes(-len(data) % align))
+        offset += len(data) + -len(data) % align
+
+    return b"MPK\x00" + struct.pack("<2I", 0x20000, len(members)) + bytes(0x34) + b"".join(table) + b"".join(body)
+
+
+def make_gxt(width: int, height: int, swizzled: bool = True, compressed: bool = False, seed: int = 0) -> bytes:
+    """
+    Make a single texture P8_ARGB GXT file
+
+    :param width: texture width
+    :param height: texture height
+    :param swizzled: swizzled or linear texture
+    :param compressed: zlib compress the file
+    :param seed: random seed
+
+    :return: gxt data
+    """
+    rng = random.Random(seed)
+    # linear rows are padded to 8 pixels
+    stride = width if swizzled else (width + 7) // 8 * 8
+    pixels = rng.randbytes(stride * height)
+    palette = rng.randbytes(0x400)
+
+    offset = 0x40
+    header = b"GXT\x00" + struct.pack("2H", 3, 0x1000) + struct.pack("6I", 1, offset, len(pixels) + len(palette), 0, 1, 0)
+    texture_type = 0x00000000 if swizzled else 0x60000000
+    info = struct.pack("6I2H", offset, len(pixels), 0, 0, texture_type, 0x95001000, width, height).ljust(0x20, b"\x00")
+
+    data = header + info + pixels + palette
+    return zlib.compress(data) if compressed else data
+
+
+def make_lay(
+    levels: list[int],
+    tiles: int,
+    size: int = 1024,
+    seed: int = 0,
+    compressed: bool = False,
+) -> tuple[bytes, Image.Image]:
+    """
+    Make a lay file and its tiles image
+
+    :param levels: compose tree level of every part, e.g. [0, 1, 2, 2, 1] gives the variants 0-1-2, 0-1-3, 0-4
+    :param tiles: number of tiles per part
+    :param size: width and height of the tiles image
+    :param seed: random seed
+    :param compressed: zlib compress the lay file
+
+    :return: (lay data, tiles image)
+    """
+    rng = random.Random(seed)
+    source = Image.frombytes("RGBA", (size, size), rng.randbytes(size * size * 4))
+
+    table = b""
+    records = []
+    for i_part, level in enumerate(levels):
+        table += struct.pack("<4bI4x", 0, 0, 0, level * 0x10, i_part * tiles)
+        for i_tile in range(tiles):
+            records.append(
+                struct.pack(
+                    "<4f",
+                    (i_tile % 16) * 30 - 240 + i_part * 4,
+                    (i_tile // 16) * 30 - 240 + i_part * 2,
+                    rng.randrange(size // 32) * 32 + 1,
+                    rng.randrange(size // 32) * 32 + 1,
+                )
+            )
+
+    data = struct.pack("<2I", len(levels), len(levels) * tiles) + table + b"".join(records)
+    return zlib.compress(data) if compressed else data, source
+
+
+def make_mvl(
+    layers: int,
+    quads: int,
+    tile: int = 32,
+    size: int = 512,
+    seed: int = 0,
+    compressed: bool = True,
+) -> tuple[bytes, Image.Image]:
+    """
+    Make a mvl file and its picture
+
+    :param layers: number of layers
+    :param quads: number of tile quads per layer
+    :param tile: quad size in pixels
+    :param size: width and height of the picture
+    :param seed: random seed
+    :param compressed: zlib compress the mvl file
+
+    :return: (mvl data, picture)
+    """
+    rng = random.Random(seed)
+    picture = Image.frombytes("RGBA", (size, size), rng.randbytes(size * size * 4))
+
+    meshes = []
+    for i_layer in range(layers):
+        vertices = []
+        indexes = []
+        for i_quad in range(quads):
+            x = tile * (i_quad % 16) - 256 + 10 * i_layer
+            y = tile * (i_quad // 16) - 256 + 7 * i_layer
+            u = tile * rng.randrange(size // tile - 1) / size
+            v = tile * rng.randrange(size // tile - 1) / size
+            du = dv = tile / size
+            first = len(vertices)
+            vertices += [(x, y, 0, u, v), (x + tile, y, 0, u + du, v), (x, y + tile, 0, u, v + dv), (x + tile, y + tile, 0, u + du, v + dv)]
+            # two triangles per quad
+            indexes += [first, first + 1, first + 2, first + 2, first + 1, first + 3]
+        meshes.append((vertices, indexes))
+
+    # vertex buffers, then index buffers
+    vertex_offset = 0x60 + 0x40 * layers
+    vertex_data = b""
+    vertex_offsets = []
+    for vertices, _ in meshes:
+        vertex_offsets.append(vertex_offset + len(vertex_data))
+        vertex_data += b"".join(struct.pack("<5f", *vertex) for vertex in vertices)
+
+    index_offset = vertex_offset + len(vertex_data)
+    index_data = b""
+    index_offsets = []
+    for _, indexes in meshes:
+        index_offsets.append(index_offset + len(index_data))
+        index_data += struct.pack("<%dH" % len(indexes), *indexes)
+
+    data = b"MVL1" + struct.pack("<I", layers) + bytes(24) + b"XFYF0FUFVF"
+    data = data.ljust(0x60, b"\x00")
+    for i_layer, (vertices, indexes) in enumerate(meshes):
+        data += bytes(8) + b"\x04\x01\x00\x01\x00\x00\x00\x00"
+        data += struct.pack("<4I", len(vertices), vertex_offsets[i_layer], len(indexes), index_offsets[i_layer])
+        data += ("layer%d" % i_layer).encode().ljust(0x20, b"\x00")
+    data += vertex_data + index_data
+
+    return zlib.compress(data) if compressed else data, picture
+
+
+def png_bytes(image: Image.Image) -> bytes:
+    """
+    Encode an image as PNG
+
+    :param image: the image
+    :return: png data
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
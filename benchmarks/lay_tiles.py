@@ -0,0 +1,53 @@
+"""
+Tiles per second of lay part drawing, NumPy blitting against Pillow crop and paste
+
+    python -m benchmarks.lay_tiles [--parts N] [--tiles N] [--repeat N]
+"""
+import time
+from argparse import ArgumentParser
+
+from PIL import Image
+
+from libs import lay
+
+from benchmarks.fixtures import make_lay
+
+
+def bench(lay_data: bytes, source: Image.Image, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in lay.render_lay_images(lay.LaySprite(lay_data, source), "0.png", save_composed=False):
+            pass
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = ArgumentParser(description="lay tile drawing benchmark")
+    parser.add_argument("--parts", type=int, default=16)
+    parser.add_argument("--tiles", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # one base part, the others on the second level
+    lay_data, source = make_lay([0] + [1] * (args.parts - 1), args.tiles)
+    source.load()
+    total = args.parts * args.tiles
+
+    numpy = lay.np
+    results = {}
+    try:
+        lay.np = None
+        results["pillow"] = bench(lay_data, source, args.repeat)
+    finally:
+        lay.np = numpy
+    if numpy is not None:
+        results["numpy"] = bench(lay_data, source, args.repeat)
+
+    for name, seconds in results.items():
+        print("{:8} {:10.0f} tiles/s".format(name, total / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Benchmark the parsers and extractors on synthetic files, results are printed as JSON
+
+    python -m benchmarks.run [--repeat N] [--quick] [--output PATH]
+
+Every result has the best wall time of `repeat` runs, with the throughput in MB/s of input bytes and in items/s,
+so the output of two commits can be compared.
+"""
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import libs
+from libs import gxt, mvl
+from libs.output import ImageWriter
+
+from benchmarks.fixtures import make_gxt, make_lay, make_mpk, make_mvl, png_bytes
+
+
+def measure(function, repeat: int, setup=None) -> float:
+    """
+    Best wall time of a function
+
+    :param function: the function to time
+    :param repeat: number of runs
+    :param setup: called before every run, not timed
+
+    :return: seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def result(name: str, params: dict, seconds: float, size: int, items: int, unit: str) -> dict:
+    return {
+        "name": name,
+        "params": params,
+        "seconds": seconds,
+        "bytes": size,
+        "mb_per_s": size / seconds / 1e6,
+        "items": items,
+        "items_per_s": items / seconds,
+        "unit": unit,
+    }
+
+
+def bench_mpk(folder: Path, repeat: int, quick: bool) -> list[dict]:
+    results = []
+    for count in (1000,) if quick else (1000, 10000, 50000):
+        # table parsing only, members are tiny
+        path = folder / f"table_{count}.mpk"
+        path.write_bytes(make_mpk([(f"dir{i % 32}/file{i}.bin", b"x") for i in range(count)], align=16))
+        seconds = measure(lambda: libs.get_files_info_in_mpk(path), repeat)
+        results.append(result("get_files_info_in_mpk", {"members": count}, seconds, count * 0x100, count, "members"))
+
+    for count, member_size in ((64, 64 * 1024),) if quick else ((64, 64 * 1024), (1024, 16 * 1024), (16, 4 * 1024 * 1024)):
+        path = folder / f"unpack_{count}_{member_size}.mpk"
+        path.write_bytes(make_mpk([(f"dir{i % 8}/file{i}.bin", bytes([i % 256]) * member_size) for i in range(count)]))
+        for jobs in (1, 4):
+            out = folder / f"unpack_{count}_{member_size}_{jobs}"
+            seconds = measure(lambda: libs.unpack_mpk(path, out, jobs=jobs), repeat)
+            params = {"members": count, "member_size": member_size, "jobs": jobs}
+            results.append(result("unpack_mpk", params, seconds, count * member_size, count, "members"))
+    return results
+
+
+def bench_gxt(folder: Path, repeat: int, quick: bool) -> list[dict]:
+    results = []
+    for size in (256, 1024) if quick else (256, 1024, 2048):
+        for swizzled in (True, False):
+            for compressed in (False, True):
+                path = folder / f"{size}_{int(swizzled)}_{int(compressed)}.gxt"
+                path.write_bytes(make_gxt(size, size, swizzled, compressed))
+                out = folder / (path.stem + ".png")
+                seconds = measure(lambda: libs.extract_gxt_image(path, out), repeat)
+                params = {"size": size, "swizzled": swizzled, "compressed": compressed}
+                results.append(result("extract_gxt_image", params, seconds, size * size, 1, "textures"))
+
+        pixels = bytes(range(256)) * (size * size // 256)
+        # a batch of textures of one size reuses the cached map, the first one builds it
+        seconds = measure(lambda: gxt.unswizzle(pixels, size, size), repeat)
+        results.append(result("unswizzle", {"size": size}, seconds, size * size, 1, "textures"))
+        seconds = measure(lambda: gxt.unswizzle(pixels, size, size), repeat, gxt._unswizzle_map.cache_clear)
+        results.append(result("unswizzle", {"size": size, "cold": True}, seconds, size * size, 1, "textures"))
+    return results
+
+
+def bench_lay(folder: Path, repeat: int, quick: bool) -> list[dict]:
+    results = []
+    # variants grow with the number of parts on the last level
+    trees = {"flat": [0] + [1] * 7, "deep": [0, 1, 2, 2, 2, 1, 2, 2, 3, 3, 3, 3]}
+    for tree_name, levels in trees.items():
+        for tiles in (64,) if quick else (64, 256):
+            lay_data, source = make_lay(levels, tiles)
+            (folder / f"{tree_name}_{tiles}_.lay").write_bytes(lay_data)
+            (folder / f"{tree_name}_{tiles}.png").write_bytes(png_bytes(source))
+            path = folder / f"{tree_name}_{tiles}_.lay"
+            for manifest in (False, True):
+                out = folder / f"{tree_name}_{tiles}_{int(manifest)}"
+                seconds = measure(lambda: libs.extract_lay_image(path, out, manifest=manifest), repeat)
+                params = {"tree": tree_name, "parts": len(levels), "tiles": tiles, "manifest": manifest}
+                size = len(lay_data) + (folder / f"{tree_name}_{tiles}.png").stat().st_size
+                results.append(result("extract_lay_image", params, seconds, size, len(levels) * tiles, "tiles"))
+
+            out = folder / f"{tree_name}_{tiles}_atlas"
+            seconds = measure(lambda: libs.extract_lay_image(path, out, atlas=True), repeat)
+            params = {"tree": tree_name, "parts": len(levels), "tiles": tiles, "atlas": True}
+            results.append(result("extract_lay_image", params, seconds, size, len(levels) * tiles, "tiles"))
+    return results
+
+
+def bench_mvl(repeat: int, quick: bool) -> list[dict]:
+    results = []
+    for layers, quads in ((8, 64),) if quick else ((8, 64), (64, 64), (16, 512)):
+        mvl_data, picture = make_mvl(layers, quads)
+        seconds = measure(lambda: mvl.Mvl(mvl_data).combine(picture), repeat)
+        params = {"layers": layers, "quads": quads}
+        results.append(result("Mvl.combine", params, seconds, len(mvl_data), layers, "layers"))
+    return results
+
+
+def bench_output(repeat: int, quick: bool) -> list[dict]:
+    results = []
+    _, picture = make_mvl(1, 1, size=1024 if quick else 2048)
+    size = picture.width * picture.height * 4
+    writers = [("png", None), ("png", 1), ("png", 0), ("webp", None), ("raw", None)]
+    for image_format, png_level in writers:
+        writer = ImageWriter(image_format, png_level)
+        seconds = measure(lambda: writer.encode(picture), repeat)
+        params = {"format": image_format, "png_level": png_level, "size": picture.width}
+        results.append(result("ImageWriter.encode", params, seconds, size, 1, "images"))
+    return results
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description="benchmark suite on synthetic files")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best one is kept")
+    parser.add_argument("--quick", action="store_true", help="only the smallest sizes")
+    parser.add_argument("--only", action="append", choices=["mpk", "gxt", "lay", "mvl", "output"], help="benchmark groups to run")
+    parser.add_argument("--output", type=str, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    groups = args.only or ["mpk", "gxt", "lay", "mvl", "output"]
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp:
+        folder = Path(temp)
+        if "mpk" in groups:
+            results += bench_mpk(folder, args.repeat, args.quick)
+        if "gxt" in groups:
+            results += bench_gxt(folder, args.repeat, args.quick)
+        if "lay" in groups:
+            results += bench_lay(folder, args.repeat, args.quick)
+        if "mvl" in groups:
+            results += bench_mvl(args.repeat, args.quick)
+        if "output" in groups:
+            results += bench_output(args.repeat, args.quick)
+
+    report = {
+        "commit": commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": gxt.np is not None,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Wall time of main.py for every sub command on small synthetic files, results are printed as JSON
+
+    python -m benchmarks.startup [--repeat N] [--output PATH]
+
+The files are tiny, so the time is mostly interpreter start and imports. The heavy modules loaded by each
+command are listed too.
+"""
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from benchmarks.fixtures import make_gxt, make_lay, make_mpk, make_mvl, png_bytes
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+HEAVY_MODULES = ("PIL.Image", "numpy", "sqlite3", "concurrent.futures", "multiprocessing")
+
+# run main.py, then print the heavy modules it imported
+_WRAPPER = """
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    print(",".join(m for m in {modules!r} if m in sys.modules), file=sys.stderr)
+"""
+
+
+def make_files(folder: Path) -> dict[str, list[str]]:
+    """
+    Write the input files and get the arguments of every command
+
+    :param folder: temporary folder
+    :return: {command name: main.py arguments}
+    """
+    gxt_data = make_gxt(64, 64)
+    lay_data, lay_source = make_lay([0, 1, 1], 16, size=256)
+    mvl_data, mvl_picture = make_mvl(2, 8, size=256)
+
+    (folder / "game").mkdir()
+    (folder / "game" / "a.mpk").write_bytes(
+        make_mpk([("t.gxt", gxt_data), ("c_.lay", lay_data), ("c.png", png_bytes(lay_source))], align=16)
+    )
+    (folder / "t.gxt").write_bytes(gxt_data)
+    (folder / "c_.lay").write_bytes(lay_data)
+    (folder / "c.png").write_bytes(png_bytes(lay_source))
+    (folder / "m_.mvl").write_bytes(mvl_data)
+    (folder / "m.png").write_bytes(png_bytes(mvl_picture))
+
+    out = str(folder / "out")
+    mpk = str(folder / "game" / "a.mpk")
+    return {
+        "help": [],
+        "view-mpk": ["view-mpk", mpk],
+        "unpack-mpk": ["unpack-mpk", mpk, out + "/unpack", "--force"],
+        "unpack-mpk --decode": ["unpack-mpk", mpk, out + "/decode", "--decode", "--force"],
+        "index": ["index", str(folder / "game"), out],
+        "query": ["query", out, "*.gxt"],
+        "extract-gxt": ["extract-gxt", str(folder / "t.gxt"), out + "/gxt", "--force"],
+        "extract-lay": ["extract-lay", str(folder / "c_.lay"), out + "/lay", "--force"],
+        "extract-mvl": ["extract-mvl", str(folder / "m_.mvl"), out + "/mvl", "--force"],
+    }
+
+
+def bench(arguments: list[str], repeat: int) -> dict:
+    wrapper = _WRAPPER.format(modules=HEAVY_MODULES)
+    command = [sys.executable, "-c", wrapper, str(MAIN), *arguments]
+
+    times = []
+    modules = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(command, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+        modules = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else ""
+    return {
+        "best": min(times),
+        "median": statistics.median(times),
+        "modules": modules.split(",") if modules else [],
+    }
+
+
+def bench_interpreter(repeat: int) -> dict:
+    # the floor, interpreter start without any import
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"])
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times), "modules": []}
+
+
+def main():
+    parser = ArgumentParser(description="start time of every sub command")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per command")
+    parser.add_argument("--output", type=str, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        folder = Path(temp)
+        commands = make_files(folder)
+        results = {"python -c pass": bench_interpreter(args.repeat)}
+        for name, arguments in commands.items():
+            results[name] = bench(arguments, args.repeat)
+
+    output = json.dumps({"python": sys.version.split()[0], "results": results}, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,40 @@
-from .mpk import get_files_info_in_mpk, unpack_mpk
-from .lay import extract_lay_image
-from .gxt import extract_gxt_image
+"""
+The helpers are imported on first access, so a command only loads the modules it needs (Pillow, NumPy, sqlite3)
+"""
+import importlib
+
+# exported name to the module defining it
+_EXPORTS = {
+    "get_files_info_in_mpk": "mpk",
+    "unpack_mpk": "mpk",
+    "MpkArchive": "mpk",
+    "extract_lay_image": "lay",
+    "LaySprite": "lay",
+    "extract_gxt_image": "gxt",
+    "decode_gxt": "gxt",
+    "extract_mvl_image": "mvl",
+    "unpack_mpk_decoded": "pipeline",
+    "Manifest": "manifest",
+    "Catalog": "catalog",
+    "BlobStore": "dedup",
+    "dedup_folder": "dedup",
+    "ImageWriter": "output",
+}
+_SUBMODULES = {"atlas", "catalog", "dedup", "gxt", "lay", "manifest", "models", "mpk", "mvl", "output", "pipeline", "server", "stats"}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module("." + _EXPORTS[name], __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module("." + name, __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS) | _SUBMODULES)
@@ -0,0 +1,163 @@
+"""
+Pack the parts of a sprite or the layers of a mvl file into a few atlas images
+
+The rectangles are placed with the MaxRects algorithm (best short side fit), every page is cropped to what it uses.
+"""
+from PIL import Image
+
+from . import stats
+
+# pages are at most this wide and high, larger images get a page of their own
+MAX_ATLAS_SIZE = 4096
+# transparent pixels between two images, so scaled rendering does not bleed into the neighbours
+ATLAS_PADDING = 1
+
+
+class MaxRectsBin:
+    """
+    One page of the packer, the free space is kept as a list of maximal free rectangles which may overlap
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        # (x, y, w, h)
+        self.free = [(0, 0, width, height)]
+        self.used_width = 0
+        self.used_height = 0
+
+    def insert(self, width: int, height: int) -> tuple[int, int] | None:
+        """
+        place a rectangle in the free rectangle leaving the shortest side, then the longest side, unused
+
+        :param width: rectangle width
+        :param height: rectangle height
+        :return: (x, y), or None when it does not fit
+        """
+        best = None
+        best_score = None
+        for free_x, free_y, free_w, free_h in self.free:
+            if width <= free_w and height <= free_h:
+                left_w, left_h = free_w - width, free_h - height
+                score = (min(left_w, left_h), max(left_w, left_h))
+                if best_score is None or score < best_score:
+                    best, best_score = (free_x, free_y), score
+        if best is None:
+            return None
+
+        self._split(best[0], best[1], width, height)
+        self.used_width = max(self.used_width, best[0] + width)
+        self.used_height = max(self.used_height, best[1] + height)
+        return best
+
+    def _split(self, x: int, y: int, width: int, height: int):
+        # cut every free rectangle overlapping the placed one into the up to 4 rectangles around it
+        free = []
+        for free_x, free_y, free_w, free_h in self.free:
+            if x >= free_x + free_w or x + width <= free_x or y >= free_y + free_h or y + height <= free_y:
+                free.append((free_x, free_y, free_w, free_h))
+                continue
+            if x > free_x:
+                free.append((free_x, free_y, x - free_x, free_h))
+            if x + width < free_x + free_w:
+                free.append((x + width, free_y, free_x + free_w - x - width, free_h))
+            if y > free_y:
+                free.append((free_x, free_y, free_w, y - free_y))
+            if y + height < free_y + free_h:
+                free.append((free_x, y + height, free_w, free_y + free_h - y - height))
+
+        # drop the rectangles contained in another one
+        free.sort(key=lambda rect: -rect[2] * rect[3])
+        self.free = []
+        for rect in free:
+            if not any(_contains(other, rect) for other in self.free):
+                self.free.append(rect)
+
+
+def _contains(outer: tuple, inner: tuple) -> bool:
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and inner[0] + inner[2] <= outer[0] + outer[2]
+        and inner[1] + inner[3] <= outer[1] + outer[3]
+    )
+
+
+def pack_rects(
+    sizes: list[tuple[int, int]],
+    max_size: int = MAX_ATLAS_SIZE,
+    padding: int = ATLAS_PADDING,
+) -> tuple[list[tuple[int, int]], list[tuple[int, int, int]]]:
+    """
+    place rectangles on as few pages as possible
+
+    :param sizes: list of (width, height)
+    :param max_size: page width and height
+    :param padding: space kept on the right and bottom of every rectangle
+    :return: (page sizes, (page, x, y) of every rectangle)
+    """
+    bins: list[MaxRectsBin] = []
+    places: list[tuple[int, int, int] | None] = [None] * len(sizes)
+    # large rectangles first, small ones fill the gaps
+    order = sorted(range(len(sizes)), key=lambda i: (-max(sizes[i]), -sizes[i][0] * sizes[i][1]))
+    for i in order:
+        width, height = sizes[i][0] + padding, sizes[i][1] + padding
+        if width <= padding or height <= padding:
+            # nothing to draw, any place does
+            places[i] = (0, 0, 0)
+            continue
+
+        for i_bin, page in enumerate(bins):
+            position = page.insert(width, height)
+            if position is not None:
+                places[i] = (i_bin, *position)
+                break
+        else:
+            if width > max_size or height > max_size:
+                bins.append(MaxRectsBin(width, height))
+            else:
+                bins.append(MaxRectsBin(max_size, max_size))
+            places[i] = (len(bins) - 1, *bins[-1].insert(width, height))
+
+    # the padding after the last column and row is not needed
+    page_sizes = [(max(1, page.used_width - padding), max(1, page.used_height - padding)) for page in bins]
+    return page_sizes, places
+
+
+def build_atlas(images: list[Image.Image], max_size: int = MAX_ATLAS_SIZE, padding: int = ATLAS_PADDING):
+    """
+    pack images into RGBA atlas pages
+
+    :param images: the images
+    :param max_size: page width and height
+    :param padding: transparent pixels between the images
+    :return: (pages, [{"page", "x", "y", "w", "h"}] of every image)
+    """
+    sizes = [image.size for image in images]
+    with stats.stage("atlas.pack", items=len(images)):
+        page_sizes, places = pack_rects(sizes, max_size, padding)
+
+    with stats.stage("atlas.paste", sum(w * h * 4 for w, h in sizes), len(images)) as stage:
+        pages = [Image.new("RGBA", size) for size in page_sizes]
+        rects = []
+        for image, (width, height), (i_page, x, y) in zip(images, sizes, places):
+            if width and height:
+                pages[i_page].paste(image if image.mode == "RGBA" else image.convert("RGBA"), (x, y))
+            rects.append({"page": i_page, "x": x, "y": y, "w": width, "h": height})
+        if stage:
+            stage.bytes_out = sum(w * h * 4 for w, h in page_sizes)
+    return pages, rects
+
+
+def render_atlas(images: list[Image.Image], suffix: str = ".png"):
+    """
+    pack images and name the pages
+
+    :param images: the images
+    :param suffix: extension of the page files
+    :return: ([{"file", "width", "height"}] of the pages, rects of `build_atlas`, [(file name, page image)])
+    """
+    pages, rects = build_atlas(images)
+    names = ["atlas" + str(i_page) + suffix for i_page in range(len(pages))]
+    index = [{"file": name, "width": page.width, "height": page.height} for name, page in zip(names, pages)]
+    return index, rects, list(zip(names, pages))
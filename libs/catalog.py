@@ -0,0 +1,229 @@
+import json
+import sqlite3
+import struct
+import zlib
+from os import PathLike
+from pathlib import Path
+
+from .models import ZLIB_HEADERS, GxtTextureInfo, cstr
+from .mpk import MpkArchive
+
+CATALOG_NAME = "catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    flag INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format INTEGER,
+    parts INTEGER,
+    tiles INTEGER,
+    layers TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_name ON entries(name);
+CREATE INDEX IF NOT EXISTS entries_archive ON entries(archive_id);
+"""
+
+
+def _head(data: memoryview, length: int) -> bytes:
+    # the first bytes of a member, only as much as needed is decompressed
+    if data[:2] in ZLIB_HEADERS:
+        try:
+            return zlib.decompressobj().decompress(data, length)
+        except zlib.error:
+            return b""
+    return bytes(data[:length])
+
+
+def _member_metadata(name: str, data: memoryview) -> dict:
+    """
+    cheap metadata read from the headers of a member
+
+    :param name: member name
+    :param data: member content
+    :return: kind, and width/height/format for GXT, parts/tiles for LAY, layers for MVL
+    """
+    head = _head(data, 0x40)
+    if head[:4] == b"GXT\x00":
+        kind = "gxt"
+    elif head[:4] == b"MVL1":
+        kind = "mvl"
+    elif name.lower().endswith(".lay"):
+        # lay files have no magic
+        kind = "lay"
+    elif head[:4] == b"\x89PNG":
+        return {"kind": "png"}
+    else:
+        return {"kind": Path(name).suffix[1:].lower()}
+
+    try:
+        return {"kind": kind, **_header_metadata(kind, data, head)}
+    except (ValueError, struct.error):
+        # truncated header or a layer name which is not Shift-JIS (UnicodeDecodeError), the member is still listed
+        return {"kind": kind}
+
+
+def _header_metadata(kind: str, data: memoryview, head: bytes) -> dict:
+    # width/height/format of a GXT, parts/tiles of a LAY, layers of a MVL
+    if kind == "gxt":
+        texture = GxtTextureInfo(head[0x20:0x40], check_format=False)
+        return {"width": texture.width, "height": texture.height, "format": texture.texture_format}
+
+    if kind == "mvl":
+        (count,) = struct.unpack("<I", head[4:8])
+        head = _head(data, 0x60 + count * 0x40)
+        layers = [cstr(head[0x80 + i * 0x40 : 0xA0 + i * 0x40]) for i in range(count)]
+        return {"layers": json.dumps(layers, ensure_ascii=False)}
+
+    parts, tiles = struct.unpack("<2I", head[:8])
+    return {"parts": parts, "tiles": tiles}
+
+
+class Catalog:
+    """
+    SQLite catalog of the members of many mpk files
+
+    Archives are only read again when their size or mtime changed.
+    """
+
+    def __init__(self, file: PathLike | str):
+        """
+        :param file: catalog file path, or a folder holding catalog.sqlite
+        """
+        self.path = Path(file)
+        if self.path.is_dir():
+            self.path = self.path / CATALOG_NAME
+
+        self._connection = sqlite3.connect(self.path)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(_SCHEMA)
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def update(self, folder: PathLike | str) -> tuple[int, int, int]:
+        """
+        index every mpk file under a folder
+
+        :param folder: game folder
+        :return: (updated archives, unchanged archives, removed archives)
+        """
+        known = {row["path"]: row for row in self._connection.execute("SELECT * FROM archives")}
+        seen = set()
+        updated = unchanged = 0
+
+        for mpk_path in sorted(Path(folder).rglob("*")):
+            if mpk_path.suffix.lower() != ".mpk" or not mpk_path.is_file():
+                continue
+            path = str(mpk_path.resolve())
+            seen.add(path)
+            stat = mpk_path.stat()
+
+            row = known.get(path)
+            if row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+                unchanged += 1
+                continue
+
+            try:
+                self._index_archive(mpk_path, path, stat)
+            except ValueError as e:
+                print(f"{mpk_path}: {e}")
+                continue
+            updated += 1
+
+        # archives deleted from the folder
+        removed = [path for path in known if path not in seen]
+        with self._connection:
+            self._connection.executemany("DELETE FROM archives WHERE path = ?", [(path,) for path in removed])
+        return updated, unchanged, len(removed)
+
+    def _index_archive(self, mpk_path: Path, path: str, stat):
+        with MpkArchive(mpk_path) as archive:
+            rows = []
+            for file_info in archive:
+                with archive.view(file_info) as view:
+                    metadata = _member_metadata(file_info.name, view)
+                rows.append(
+                    (
+                        file_info.index,
+                        file_info.name,
+                        file_info.offset,
+                        file_info.size,
+                        file_info.flag,
+                        metadata["kind"],
+                        metadata.get("width"),
+                        metadata.get("height"),
+                        metadata.get("format"),
+                        metadata.get("parts"),
+                        metadata.get("tiles"),
+                        metadata.get("layers"),
+                    )
+                )
+
+        # replace the archive and its entries in one transaction
+        with self._connection:
+            self._connection.execute("DELETE FROM archives WHERE path = ?", (path,))
+            archive_id = self._connection.execute(
+                "INSERT INTO archives (path, size, mtime_ns) VALUES (?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns)
+            ).lastrowid
+            self._connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(archive_id, *row) for row in rows]
+            )
+
+    def query(
+        self,
+        pattern: str = "*",
+        kind: str | None = None,
+        min_width: int | None = None,
+        min_height: int | None = None,
+        layer: str | None = None,
+    ) -> list[sqlite3.Row]:
+        """
+        find members
+
+        :param pattern: glob on the member name, e.g. "bg/*.gxt"
+        :param kind: gxt, lay, mvl, png or the file suffix
+        :param min_width: minimal GXT width
+        :param min_height: minimal GXT height
+        :param layer: glob on the MVL layer names
+        :return: rows with the archive path and the entry columns
+        """
+        conditions = ["entries.name GLOB ?"]
+        parameters: list = [pattern]
+        if kind is not None:
+            conditions.append("entries.kind = ?")
+            parameters.append(kind.lower())
+        if min_width is not None:
+            conditions.append("entries.width >= ?")
+            parameters.append(min_width)
+        if min_height is not None:
+            conditions.append("entries.height >= ?")
+            parameters.append(min_height)
+        if layer is not None:
+            conditions.append("EXISTS (SELECT 1 FROM json_each(entries.layers) WHERE json_each.value GLOB ?)")
+            parameters.append(layer)
+
+        return self._connection.execute(
+            "SELECT archives.path AS archive, entries.* FROM entries JOIN archives ON archives.id = entries.archive_id "
+            "WHERE " + " AND ".join(conditions) + " ORDER BY archives.path, entries.idx",
+            parameters,
+        ).fetchall()
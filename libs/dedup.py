@@ -0,0 +1,161 @@
+import os
+import threading
+from os import PathLike
+from pathlib import Path
+
+from .manifest import MANIFEST_NAME, hash_bytes, hash_file
+
+LINK_METHODS = ("hardlink", "reflink")
+
+# linux ioctl cloning a whole file, supported by btrfs, xfs and others
+FICLONE = 0x40049409
+
+
+def _reflink(source: Path, target: Path):
+    import fcntl
+
+    with source.open("rb") as source_file, target.open("wb") as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+
+def link_file(source: Path, target: Path, method: str = "hardlink"):
+    """
+    make target a copy of source without writing its content
+
+    :param source: existing file
+    :param target: file to replace
+    :param method: "hardlink" or "reflink"
+    :return: None
+    """
+    if method not in LINK_METHODS:
+        raise ValueError(f"unknown link method {method}")
+
+    # link under a temporary name, the target is replaced at once
+    temp_path = target.with_name(target.name + ".dedup")
+    temp_path.unlink(missing_ok=True)
+    try:
+        if method == "hardlink":
+            os.link(source, temp_path)
+        else:
+            _reflink(source, temp_path)
+        os.replace(temp_path, target)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+class _Blob:
+    def __init__(self, path: Path):
+        self.path = path
+        self.written = False
+        self.event = threading.Event()
+
+
+class BlobStore:
+    """
+    Content-addressed record of the files written, a content seen before is linked to its first file
+
+    Safe to share between threads, a duplicate waits until the first copy is written.
+    """
+
+    def __init__(self, method: str = "hardlink"):
+        """
+        :param method: "hardlink" or "reflink"
+        """
+        if method not in LINK_METHODS:
+            raise ValueError(f"unknown link method {method}")
+        self.method = method
+        self.duplicates = 0
+        self.saved_bytes = 0
+        self._blobs: dict[str, _Blob] = {}
+        self._lock = threading.Lock()
+
+    def place(self, target: Path, digest: str, size: int, write):
+        """
+        write a file, or link it to the file written first with the same content
+
+        :param target: output file
+        :param digest: content hash
+        :param size: content size
+        :param write: called with the target to write the content
+        :return: None
+        """
+        with self._lock:
+            blob = self._blobs.get(digest)
+            first = blob is None
+            if first:
+                blob = self._blobs[digest] = _Blob(target)
+
+        if not first:
+            blob.event.wait()
+            if blob.written and blob.path != target:
+                try:
+                    link_file(blob.path, target, self.method)
+                except OSError:
+                    # other file system or no reflink support, write a copy below
+                    pass
+                else:
+                    with self._lock:
+                        self.duplicates += 1
+                        self.saved_bytes += size
+                    return
+
+        try:
+            # never write through a link made by an earlier run
+            target.unlink(missing_ok=True)
+            write(target)
+            if first:
+                blob.written = True
+        finally:
+            if first:
+                blob.event.set()
+
+    def write_bytes(self, target: Path, data):
+        """
+        write bytes, or link them to the file written first with the same content
+
+        :param target: output file
+        :param data: bytes-like content
+        :return: None
+        """
+        self.place(target, hash_bytes(data), len(data), lambda path: path.write_bytes(data))
+
+    def report(self) -> str:
+        return "{} duplicates linked, {} bytes saved".format(self.duplicates, self.saved_bytes)
+
+
+def dedup_folder(folder: PathLike | str, method: str = "hardlink") -> BlobStore:
+    """
+    link the files of a folder that have the same content
+
+    :param folder: output folder
+    :param method: "hardlink" or "reflink"
+    :return: the BlobStore, with the duplicates and the bytes saved
+    """
+    store = BlobStore(method)
+
+    # only files sharing their size with another file are hashed
+    sizes: dict[int, list[Path]] = {}
+    for path in sorted(Path(folder).rglob("*")):
+        if path.is_file() and not path.is_symlink() and path.name != MANIFEST_NAME:
+            sizes.setdefault(path.stat().st_size, []).append(path)
+
+    for size, paths in sizes.items():
+        if len(paths) < 2:
+            continue
+        first_files: dict[str, Path] = {}
+        for path in paths:
+            first = first_files.setdefault(hash_file(path), path)
+            if first == path:
+                continue
+
+            # already linked by an earlier run
+            first_stat, stat = first.stat(), path.stat()
+            if (first_stat.st_dev, first_stat.st_ino) == (stat.st_dev, stat.st_ino):
+                continue
+            try:
+                link_file(first, path, method)
+            except OSError:
+                continue
+            store.duplicates += 1
+            store.saved_bytes += size
+    return store
@@ -1,63 +1,20 @@
 import io
-import struct
+import math
 import zlib
+from functools import lru_cache
 from os import PathLike
 from pathlib import Path
 
-from PIL import Image, ImageFile
+from PIL import Image, ImageFile, ImagePalette
 
+from . import stats
+from .models import TEXTURE_TYPE_LINEAR, TEXTURE_TYPE_SWIZZLED, ZLIB_HEADERS, GxtHeader, GxtTextureInfo
+from .output import ImageWriter
 
-class GxtHeader:
-    def __init__(self, data):
-        # check if a valid GXT file
-        if data[0:4] != b"GXT\x00":
-            raise ValueError("Invalid GXT header, maybe not a GXT file")
-
-        # check if a supported version
-        self.ver = struct.unpack("2H", data[4:8])
-        if self.ver != (3, 0x1000):
-            raise ValueError("Unsupported GXT version")
-
-        (
-            self.textures_count,
-            self.texture_offset,
-            self.texture_size,
-            self.palette_4_len,
-            self.palette_8_len,
-            self.Padding,
-        ) = struct.unpack("6I", data[8:0x20])
-
-        if self.palette_4_len != 0 or self.palette_8_len != 1:
-            raise ValueError("Unsupported palette length")
-
-    def get_offset(self):
-        return self.texture_offset
-
-    def get_palette_offset(self):
-        return (
-            self.texture_offset
-            + self.texture_size
-            - (self.palette_4_len * 0x40 + self.palette_8_len * 0x400)
-        )
-
-
-class GxtTextureInfo:
-    def __init__(self, data):
-        (
-            self.offset,
-            self.size,
-            self.palette_index,
-            self.flags,
-            self.texture_type,
-            self.texture_format,
-        ) = struct.unpack("6I", data[:24])
-
-        self.width, self.height = struct.unpack("2H", data[24:28])
-
-        # P8_ARGB
-        if self.texture_format != 0x95001000:
-            raise ValueError("Unsupported texture format, expected 0x95001000, got {}".format(hex(self.texture_format)))
-
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, fall back to the pure python path
+    np = None
 
 class GxtImageFile(ImageFile.ImageFile):
     """
@@ -78,9 +35,12 @@ class GxtImageFile(ImageFile.ImageFile):
         data = self.fp.read(2)
 
         # decompress if needed
-        if data in [b"\x78\x5e", b"\x78\x9c"]:
+        if data in ZLIB_HEADERS:
             self.fp.seek(0)
-            data = zlib.decompress(self.fp.read())
+            data = _decompress(self.fp.read())
+            # any zlib stream is accepted, let the other plugins try if it is not a GXT file
+            if data[:4] != b"GXT\x00":
+                raise SyntaxError("not a GXT file")
             self.fp = io.BytesIO(data)
 
         # read header
@@ -97,6 +57,26 @@ class GxtImageFile(ImageFile.ImageFile):
         self._mode = "P"
         self.tile = [("gxt", (0, 0) + self.size, 0, (self.header, self.texture))]
 
+        # the palette is applied by Image.load
+        self.fp.seek(self.header.get_palette_offset())
+        self.palette = ImagePalette.raw("RGBA", _bgrx_to_rgba(self.fp.read(0x400)))
+
+    def load(self):
+        # decode the whole texture at once instead of feeding the PyDecoder chunk by chunk
+        if self.tile and self.fp:
+            self.fp.seek(0)
+            pixels, stride = texture_pixels(self.fp.read(), self.texture)
+            self.tile = []
+
+            if self._exclusive_fp and self._close_exclusive_fp_after_loading:
+                self.fp.close()
+            self.fp = None
+
+            # the raw decoder writes the pixels into self.im, the palette read by _open is applied by Image.load
+            self.load_prepare()
+            self.frombytes(pixels, "raw", "P", stride, 1)
+        return super().load()
+
 
 class GxtDecoder(ImageFile.PyDecoder):
     def __init__(self, mode, header, texture_info):
@@ -111,17 +91,20 @@ class GxtDecoder(ImageFile.PyDecoder):
         else:
             palette_offset = self.header.get_palette_offset()
             palette = buf[palette_offset:]
-            buf = buf[self.texture.offset : self.texture.size + self.texture.offset]
+            buf = memoryview(buf)[self.texture.offset : self.texture.size + self.texture.offset]
             buf = aligned(buf, self.texture.width)
-            self.set_as_raw(self.order_texture(buf, self.texture.texture_type))
+            data = self.order_texture(buf, self.texture.texture_type)
+            if np is not None and isinstance(data, np.ndarray):
+                data = np.ascontiguousarray(data)
+            self.set_as_raw(data)
             self.im.putpalette("BGRX", palette)
             self.im.putpalettealphas(palette[3::4])
         return -1, 0
 
     def order_texture(self, data, texture_type):
-        if texture_type == 0x60000000:
+        if texture_type == TEXTURE_TYPE_LINEAR:
             return data
-        if texture_type == 0x00000000:
+        if texture_type == TEXTURE_TYPE_SWIZZLED:
             return unswizzle(data, self.im.size[0], self.im.size[1])
         return data
 
@@ -133,23 +116,29 @@ def aligned(buf: bytes, width: int):
     :param buf: the buffer to extract data
     :param width: the width of data size
 
-    :return: the extracted data
+    :return: the extracted data, a strided (rows, width) array view over `buf` when numpy is available
     """
     # already aligned
     if width % 8 == 0:
         return buf
 
     aligned_segment_size = width + 8 - width % 8
-    ret = b""
-    while len(buf) > 0:
-        ret += buf[:width]
-        buf = buf[aligned_segment_size:]
-    return ret
+    rows, tail = divmod(len(buf), aligned_segment_size)
+
+    if np is not None and tail == 0:
+        # no copy, rows are read through the padded buffer
+        return np.frombuffer(buf, dtype=np.uint8).reshape(rows, aligned_segment_size)[:, :width]
+
+    # single copy of the packed rows, including a trailing partial segment
+    view = memoryview(buf)
+    return b"".join(
+        view[offset : offset + width] for offset in range(0, len(view), aligned_segment_size)
+    )
 
 
 # TODO Refactor below functions
 def _compact(x):
-    x &= 0x55555555  # x = -f-e -d-c -b-a -9-8 -7-6 -5-4 -3-2 -1-0
+    x = x & 0x55555555  # x = -f-e -d-c -b-a -9-8 -7-6 -5-4 -3-2 -1-0
     x = (x ^ (x >> 1)) & 0x33333333  # x = --fe --dc --ba --98 --76 --54 --32 --10
     x = (x ^ (x >> 2)) & 0x0F0F0F0F  # x = ---- fedc ---- ba98 ---- 7654 ---- 3210
     x = (x ^ (x >> 4)) & 0x00FF00FF  # x = ---- ---- fedc ba98 ---- ---- 7654 3210
@@ -157,14 +146,17 @@ def _compact(x):
     return x
 
 
-def unswizzle(data, width, height):
-    import math
-
+def _swizzle_masks(width, height):
     m = min(width, height)
     k = int(math.log(m, 2))
     assert 2 ** k == m, ""
     m = m - 1  # 0xf...f
     head = 0xFFFFFFFF ^ m
+    return k, m, head
+
+
+def _unswizzle_python(data, width, height):
+    k, m, head = _swizzle_masks(width, height)
     if width > height:
 
         def get_xy(i):
@@ -184,17 +176,137 @@ def unswizzle(data, width, height):
     return bytes(ret)
 
 
-Image.register_open("GXT", GxtImageFile)
+@lru_cache(maxsize=16)
+def _unswizzle_map(width, height):
+    """
+    Build the gather map of a swizzled texture, `linear[j] = swizzled[map[j]]`
+
+    :param width: texture width
+    :param height: texture height
+
+    :return: read-only index array of `width * height` items
+    """
+    k, m, head = _swizzle_masks(width, height)
+    i = np.arange(width * height, dtype=np.uint32)
+    if width > height:
+        x = (i >> k) & head | (_compact(i >> 1) & m)
+        y = _compact(i) & m
+    else:
+        x = _compact(i) & m
+        y = (_compact(i >> 1) & m) | (i >> k) & head
+
+    index_map = np.empty(width * height, dtype=np.intp)
+    index_map[y.astype(np.intp) * width + x] = np.arange(width * height, dtype=np.intp)
+    index_map.flags.writeable = False
+    return index_map
+
+
+def unswizzle(data, width, height):
+    """
+    Convert a Morton (Z-order) swizzled texture into linear rows
+
+    :param data: the swizzled pixels, one byte per pixel, as a buffer or an array view
+    :param width: texture width
+    :param height: texture height
+
+    :return: the linear pixels
+    """
+    with stats.stage("gxt.unswizzle", width * height) as stage:
+        if stage:
+            stage.bytes_out = width * height
+
+        if np is None:
+            return _unswizzle_python(data, width, height)
+
+        if isinstance(data, np.ndarray):
+            pixels = data.reshape(-1)
+        else:
+            pixels = np.frombuffer(data, dtype=np.uint8)
+        if len(pixels) < width * height:
+            pixels = np.pad(pixels, (0, width * height - len(pixels)))
+        return pixels[_unswizzle_map(width, height)].tobytes()
+
+
+def _decompress(data: bytes) -> bytes:
+    with stats.stage("gxt.decompress", len(data)) as stage:
+        data = zlib.decompress(data)
+        if stage:
+            stage.bytes_out = len(data)
+    return data
+
+
+def _bgrx_to_rgba(palette):
+    # the X channel of GXT palettes holds the alpha
+    rgba = bytearray(len(palette))
+    rgba[0::4] = palette[2::4]
+    rgba[1::4] = palette[1::4]
+    rgba[2::4] = palette[0::4]
+    rgba[3::4] = palette[3::4]
+    return bytes(rgba)
+
+
+def texture_pixels(data: bytes, texture: GxtTextureInfo) -> tuple[bytes | memoryview, int]:
+    """
+    The linear "P" pixels of a texture, for the raw decoder
+
+    :param data: the GXT file content, not compressed
+    :param texture: the texture info
+
+    :return: (pixels, row stride), a stride of 0 means rows of the texture width
+    """
+    pixels = memoryview(data)[texture.offset : texture.offset + texture.size]
+    if texture.texture_type == TEXTURE_TYPE_SWIZZLED:
+        return unswizzle(aligned(pixels, texture.width), texture.width, texture.height), 0
+
+    stride = texture.width if texture.width % 8 == 0 else texture.width + 8 - texture.width % 8
+    if len(pixels) >= stride * texture.height:
+        # the raw decoder skips the row padding by itself
+        return pixels, stride
+    # the last row is not padded
+    return bytes(aligned(pixels, texture.width)), 0
+
+
+def decode_gxt(data: bytes) -> Image.Image:
+    """
+    Decode GXT texture bytes into a "P" mode image without going through the PyDecoder
+
+    :param data: the GXT file content, zlib compressed or not
+
+    :return: the decoded image with the palette and alpha attached
+    """
+    if data[:2] in ZLIB_HEADERS:
+        data = _decompress(data)
+
+    header = GxtHeader(data[:0x20])
+    if header.textures_count != 1:
+        raise ValueError("multi textures not supported")
+    texture = GxtTextureInfo(data[0x20:0x40])
+    size = (texture.width, texture.height)
+
+    pixels, stride = texture_pixels(data, texture)
+    image = Image.frombuffer("P", size, pixels, "raw", "P", stride, 1)
+
+    palette_offset = header.get_palette_offset()
+    image.putpalette(_bgrx_to_rgba(data[palette_offset : palette_offset + 0x400]), "RGBA")
+    return image
+
+
+def _accept(prefix: bytes) -> bool:
+    return prefix[:4] == b"GXT\x00" or prefix[:2] in ZLIB_HEADERS
+
+
+Image.register_open("GXT", GxtImageFile, _accept)
 Image.register_decoder("gxt", GxtDecoder)
 Image.register_extension("GXT", ".gxt")
 
 
-def extract_gxt_image(file: PathLike | str, output_file: PathLike | str | None = None):
+def extract_gxt_image(file: PathLike | str, output_file: PathLike | str | None = None, writer: ImageWriter | None = None):
     """
     Extract GXT image to PNG
 
     :param file: the GXT file
     :param output_file: the output PNG file, if None, will use the same name as the GXT file with PNG extension
+    :param writer: output format, PNG by default, the extension of `output_file` is replaced by the one of the format
 
     :return: None
     """
@@ -204,5 +316,14 @@ def extract_gxt_image(file: PathLike | str, output_file: PathLike | str | None =
     else:
         output_file = file.with_suffix(".png")
 
-    with Image.open(file, formats=["GXT"]) as img:
-        img.save(output_file)
+    owned = writer is None
+    writer = writer or ImageWriter()
+    try:
+        with Image.open(file, formats=["GXT"]) as img:
+            writer.save(img, output_file)
+    finally:
+        # wait for the background write, a writer built here also stops its threads
+        if owned:
+            writer.close()
+        else:
+            writer.flush()
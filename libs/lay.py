@@ -1,31 +1,30 @@
+import json
 import struct
 import zlib
+from collections import OrderedDict
+from collections.abc import Callable
 from os import PathLike
 from pathlib import Path
 
 from PIL import Image
 
+from . import stats
+from .atlas import render_atlas
+from .output import ImageWriter, write_bytes
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, fall back to Pillow crop and paste
+    np = None
+
 CANVAS_SIZE = (4000, 4000)
 SOURCE_TILE_SIZE = 32
 DRAW_TILE_SIZE = SOURCE_TILE_SIZE
+# bytes of rendered images kept by LaySprite and of intermediate composites kept by LayCompositor
+COMPOSITE_CACHE_SIZE = 256 * 1024 * 1024
 
 
-def extract_lay_image(
-    file: PathLike | str,
-    extract_folder: PathLike | str | None = None,
-    save_parts=True,
-    save_composed=True,
-):
-    """
-    decrypt lay image file
-
-    :param file: png/lay file path
-    :param extract_folder: folder to extract the images
-    :param save_parts: save the parts
-    :param save_composed: save the composed image
-
-    :return: None
-    """
+def _lay_paths(file: PathLike | str) -> tuple[Path, Path]:
     file_path = Path(file)
 
     # get file paths
@@ -44,38 +43,33 @@ def extract_lay_image(
     if not lay_path.exists():
         raise FileNotFoundError(f"cannot find {lay_path}")
 
-    # read lay file
-    with lay_path.open("rb") as lay_file:
-        lay_raw_data = lay_file.read()
-
-    # read lay data
-    lay_data_compressed = lay_raw_data[:2] == b"\x78\x9c"
-    lay_data = zlib.decompress(lay_raw_data) if lay_data_compressed else lay_raw_data
+    return png_path, lay_path
 
-    lay_data_pointer = 0
 
-    # the head of the file is the number of parts and tiles
-    part_count, tile_count = struct.unpack(
-        "<2I", lay_data[lay_data_pointer : lay_data_pointer + 8]
-    )
-    lay_data_pointer += 8
-
-    # image information following
-    part_number: list[int] = []
-    compose_tree: list = []
-    for i in range(part_count):
-        compose_tree.append(
-            struct.unpack("<4b", lay_data[lay_data_pointer : lay_data_pointer + 4])
-        )
-        lay_data_pointer += 4
+def extract_lay_image(
+    file: PathLike | str,
+    extract_folder: PathLike | str | None = None,
+    save_parts=True,
+    save_composed=True,
+    manifest=False,
+    writer: ImageWriter | None = None,
+    atlas=False,
+):
+    """
+    decrypt lay image file
 
-        part_number.append(
-            struct.unpack("<I", lay_data[lay_data_pointer : lay_data_pointer + 4])[0]
-        )  # the block number of image
-        lay_data_pointer += 4
+    :param file: png/lay file path
+    :param extract_folder: folder to extract the images
+    :param save_parts: save the parts
+    :param save_composed: save the composed image
+    :param manifest: save the parts and an index.json of the part boxes and variant stacks instead of the composed images
+    :param writer: output format of the images, PNG by default
+    :param atlas: like `manifest`, with the parts packed into a few atlas images instead of one file per part
 
-        # I have no idea about this segment
-        lay_data_pointer += 4
+    :return: None
+    """
+    file_path = Path(file)
+    png_path, lay_path = _lay_paths(file_path)
 
     # get extract path
     if extract_folder:
@@ -87,105 +81,483 @@ def extract_lay_image(
 
     # create extract folder
     extract_folder.mkdir(parents=True, exist_ok=True)
-    if save_parts:
+    if (save_parts or manifest) and not atlas:
         parts_folder.mkdir(exist_ok=True)
-    if save_composed:
+    if save_composed and not manifest and not atlas:
         composed_folder.mkdir(exist_ok=True)
 
-    # source png file
-    source_image = Image.open(png_path, formats=["PNG"])
+    owned = writer is None
+    writer = writer or ImageWriter()
+    try:
+        sprite = LaySprite.open(lay_path)
+        if manifest or atlas:
+            render = render_lay_atlas if atlas else render_lay_manifest
+            for output_path, output in render(sprite, writer.suffix):
+                if isinstance(output, bytes):
+                    write_bytes(extract_folder / output_path, output)
+                else:
+                    writer.save(output, extract_folder / output_path)
+        else:
+            for image_path, image in render_lay_images(sprite, png_path.name, save_parts, save_composed, writer.suffix):
+                writer.save(image, extract_folder / image_path)
+    finally:
+        # wait for the background writes of this file, a writer built here also stops its threads
+        if owned:
+            writer.close()
+        else:
+            writer.flush()
 
-    # get the parts
-    part_images = []
-    part_position = []
 
-    # draw parts
-    for i_part in range(part_count):
-        # calculate part tile count
-        if i_part + 1 < part_count:
-            part_tile_count = part_number[i_part + 1] - part_number[i_part]
-        else:
-            part_tile_count = tile_count - part_number[i_part]
+def render_lay_images(
+    sprite: "LaySprite",
+    name: str,
+    save_parts=True,
+    save_composed=True,
+    suffix=".png",
+):
+    """
+    render the parts and composed images of a lay sprite
 
-        # compose tiles into parts
-        canvas = Image.new("RGBA", CANVAS_SIZE)
-        min_x, min_y, max_x, max_y = canvas.size[0], canvas.size[1], 0, 0
+    :param sprite: the lay sprite
+    :param name: file name of the composed image when there is only one part
+    :param save_parts: render the parts
+    :param save_composed: render the composed images
+    :param suffix: extension of the image files
 
-        for i_tile in range(part_tile_count):
-            part_x, part_y, source_x, source_y = struct.unpack(
-                "<4f", lay_data[lay_data_pointer : lay_data_pointer + 16]
-            )
-            lay_data_pointer += 16
+    :return: generator of (path relative to the extract folder, image)
+    """
+    if save_parts:
+        for i_part in range(sprite.part_count):
+            yield Path("parts") / (str(i_part) + suffix), sprite.part(i_part)
 
-            # part position relative to image center
-            part_x += canvas.size[0] / 2
-            part_y += canvas.size[1] / 2
+    if save_composed:
+        # only one part
+        if sprite.part_count == 1:
+            yield Path("composed") / Path(name).with_suffix(suffix), sprite.part(0)
+            return
+
+        for i_image in range(len(sprite.variants)):
+            yield Path("composed") / (str(i_image) + suffix), sprite.variant(i_image, cache=False)
+
+
+def render_lay_manifest(sprite: "LaySprite", suffix=".png"):
+    """
+    render every part once and describe the composed images, so a viewer can stack the parts itself
+
+    :param sprite: the lay sprite
+    :param suffix: extension of the part files
+    :return: generator of (path relative to the extract folder, image), then ("index.json", json bytes)
+    """
+    for i_part in range(sprite.part_count):
+        yield Path("parts") / (str(i_part) + suffix), sprite.part(i_part)
+    yield Path("index.json"), json.dumps(sprite.manifest(suffix)).encode()
+
+
+def render_lay_atlas(sprite: "LaySprite", suffix=".png"):
+    """
+    like `render_lay_manifest`, the parts are packed into atlas images and located by their rects in index.json
+
+    :param sprite: the lay sprite
+    :param suffix: extension of the atlas files
+    :return: generator of (path relative to the extract folder, atlas image), then ("index.json", json bytes)
+    """
+    index, rects, pages = render_atlas([sprite.part(i_part) for i_part in range(sprite.part_count)], suffix)
+    for name, page in pages:
+        yield Path(name), page
+
+    manifest = sprite.manifest(suffix)
+    for part, rect in zip(manifest["parts"], rects):
+        del part["file"]
+        part.update(rect)
+    manifest["atlas"] = index
+    yield Path("index.json"), json.dumps(manifest).encode()
 
+
+class LaySprite:
+    """
+    A lay file with its tiles image
+
+    The tables are parsed once, parts and composed variants are rendered on request and cached.
+    """
+
+    def __init__(self, lay_raw_data: bytes, source_image: Image.Image, cache_size: int = COMPOSITE_CACHE_SIZE):
+        """
+        :param lay_raw_data: lay file content, zlib compressed or not
+        :param source_image: the tiles image paired with the lay file
+        :param cache_size: bytes of rendered images to keep
+        """
+        self.source_image = source_image
+        self._source = None
+        self._cache = _ImageCache(cache_size)
+
+        # read lay data
+        lay_data_compressed = lay_raw_data[:2] == b"\x78\x9c"
+        lay_data = zlib.decompress(lay_raw_data) if lay_data_compressed else lay_raw_data
+
+        lay_data_pointer = 0
+
+        # the head of the file is the number of parts and tiles
+        part_count, tile_count = struct.unpack(
+            "<2I", lay_data[lay_data_pointer : lay_data_pointer + 8]
+        )
+        lay_data_pointer += 8
+
+        # image information following
+        part_number: list[int] = []
+        compose_tree: list = []
+        for i in range(part_count):
+            compose_tree.append(
+                struct.unpack("<4b", lay_data[lay_data_pointer : lay_data_pointer + 4])
+            )
+            lay_data_pointer += 4
+
+            part_number.append(
+                struct.unpack("<I", lay_data[lay_data_pointer : lay_data_pointer + 4])[0]
+            )  # the block number of image
+            lay_data_pointer += 4
+
+            # I have no idea about this segment
+            lay_data_pointer += 4
+
+        # read the tile records of every part first, so the part boxes are known before drawing
+        part_starts: list[int] = []
+        part_tile_total = 0
+        for i_part in range(part_count):
+            # calculate part tile count
+            if i_part + 1 < part_count:
+                part_tile_count = part_number[i_part + 1] - part_number[i_part]
+            else:
+                part_tile_count = tile_count - part_number[i_part]
+
+            part_starts.append(part_tile_total)
+            part_tile_total += part_tile_count
+        part_starts.append(part_tile_total)
+
+        self.part_count = part_count
+        self.compose_tree = compose_tree
+        self._tiles = _read_tiles(lay_data, lay_data_pointer, part_tile_total)
+        self._part_starts = part_starts
+        self.part_position = [_part_box(self._part_tiles(i_part)) for i_part in range(part_count)]
+        self.variants = self._variants()
+        # one cache bounded by cache_size for the parts, the variants and the intermediate composites
+        self._compositor = LayCompositor(self.part, self.part_position, cache=self._cache)
+
+    @classmethod
+    def open(cls, file: PathLike | str, cache_size: int = COMPOSITE_CACHE_SIZE) -> "LaySprite":
+        """
+        load a lay sprite from its png or lay file
+
+        :param file: png/lay file path
+        :param cache_size: bytes of rendered images to keep
+        :return: LaySprite
+        """
+        png_path, lay_path = _lay_paths(file)
+
+        # read lay file
+        with lay_path.open("rb") as lay_file:
+            lay_raw_data = lay_file.read()
+
+        # source png file
+        with Image.open(png_path, formats=["PNG"]) as source_image:
+            source_image.load()
+        return cls(lay_raw_data, source_image, cache_size)
+
+    @property
+    def max_bytes(self) -> int:
+        """
+        bytes of images the sprite may hold: the tiles image, its pixel array for numpy and the full cache
+        """
+        source = self.source_image.width * self.source_image.height * len(self.source_image.getbands())
+        return source * (2 if np is not None else 1) + self._cache.size
+
+    def _variants(self) -> list[tuple[int, ...]]:
+        # the part stacks of the composed images, iter tree by DFS
+        variants = []
+        compose_path = [-1] * 7
+        last = -1
+        for i_part in range(self.part_count + 1):
+            # path meets end
+            if i_part >= self.part_count or int(self.compose_tree[i_part][3] / 0x10) <= last:
+                variants.append(tuple(compose_path[i_path] for i_path in range(last + 1) if compose_path[i_path] != -1))
+
+            if i_part < self.part_count:
+                last = int(self.compose_tree[i_part][3] / 0x10)
+                compose_path[last] = i_part
+        return variants
+
+    def manifest(self, suffix=".png") -> dict:
+        """
+        describe the sprite as a layer manifest
+
+        :param suffix: extension of the part files
+        :return: {"parts": [{"file", "min_x", "min_y", "max_x", "max_y"}], "variants": [[part index, ...]]},
+            boxes are in canvas coordinates and variants list their parts bottom first
+        """
+        parts = []
+        for i_part, (min_x, min_y, max_x, max_y) in enumerate(self.part_position):
+            parts.append(
+                {
+                    "file": "parts/" + str(i_part) + suffix,
+                    "min_x": min_x,
+                    "min_y": min_y,
+                    "max_x": max_x,
+                    "max_y": max_y,
+                }
+            )
+        return {"parts": parts, "variants": [list(variant) for variant in self.variants]}
+
+    def _part_tiles(self, i_part: int):
+        return self._tiles[self._part_starts[i_part] : self._part_starts[i_part + 1]]
+
+    def part(self, i_part: int) -> Image.Image:
+        """
+        render a part, the image is shared with the cache and must not be modified
+
+        :param i_part: part index
+        :return: part image, its box in canvas coordinates is `part_position[i_part]`
+        """
+        key = ("part", i_part)
+        image = self._cache.get(key)
+        if image is None:
+            image = self._draw_part(i_part)
+            self._cache.put(key, image)
+        return image
+
+    def variant(self, i_variant: int, cache=True) -> Image.Image:
+        """
+        render a composed variant, the image is shared with the cache and must not be modified
+
+        :param i_variant: index in `variants`
+        :param cache: keep the image in the cache
+        :return: composed image
+        """
+        key = ("variant", i_variant)
+        image = self._cache.get(key)
+        if image is None:
+            image, _ = self._compositor.compose(self.variants[i_variant])
+            if cache:
+                self._cache.put(key, image)
+        return image
+
+    def _draw_part(self, i_part: int) -> Image.Image:
+        part_tiles = self._part_tiles(i_part)
+        with stats.stage("lay.blit", len(part_tiles) * SOURCE_TILE_SIZE * SOURCE_TILE_SIZE * 4, len(part_tiles)) as stage:
+            image = self._blit_part(i_part, part_tiles)
+            if stage:
+                stage.bytes_out = image.width * image.height * 4
+        return image
+
+    def _blit_part(self, i_part: int, part_tiles) -> Image.Image:
+        part_box = self.part_position[i_part]
+        min_x, min_y = part_box[:2]
+
+        # compose tiles into a canvas of the part size
+        if np is not None:
+            if self._source is None:
+                self._source = _source_array(self.source_image)
+            return _blit_tiles(*self._source, part_tiles, part_box)
+
+        canvas = Image.new("RGBA", (part_box[2] - part_box[0], part_box[3] - part_box[1]))
+        for part_x, part_y, source_x, source_y in part_tiles:
             # copy from source image
-            tile_image = source_image.crop(
+            tile_image = self.source_image.crop(
                 (
-                    int(source_x) - 1,
-                    int(source_y) - 1,
-                    int(source_x) + SOURCE_TILE_SIZE - 1,
-                    int(source_y) + SOURCE_TILE_SIZE - 1,
+                    source_x - 1,
+                    source_y - 1,
+                    source_x + SOURCE_TILE_SIZE - 1,
+                    source_y + SOURCE_TILE_SIZE - 1,
                 )
             )
 
             # paste to canvas
-            part_x, part_y = int(part_x), int(part_y)
-            canvas.paste(tile_image, (part_x, part_y))
+            canvas.paste(tile_image, (part_x - min_x, part_y - min_y))
+        return canvas
 
-            # update drawing box
-            min_x = min(min_x, part_x)
-            min_y = min(min_y, part_y)
-            max_x = max(max_x, part_x)
-            max_y = max(max_y, part_y)
 
-        # crop the part and append to list
-        part_box = (min_x, min_y, max_x + DRAW_TILE_SIZE, max_y + DRAW_TILE_SIZE)
-        cropped_part = canvas.crop(part_box)
-        part_position.append(part_box)
-        part_images.append(cropped_part)
+class LayCompositor:
+    """
+    Composes stacks of parts, reusing the cached composite of the longest known prefix of a stack
 
-        if save_parts:
-            cropped_part.save(parts_folder / (str(i_part) + ".png"))
+    Intermediate composites are kept in a LRU cache bounded by `cache_size` bytes, or in a cache shared with the caller.
+    """
 
-    if save_composed:
-        # only one part
-        if part_count == 1:
-            part_images[0].save(composed_folder / png_path.name)
+    def __init__(
+        self,
+        part_image: Callable[[int], Image.Image],
+        part_position: list[tuple],
+        cache_size: int = COMPOSITE_CACHE_SIZE,
+        cache: "_ImageCache | None" = None,
+    ):
+        """
+        :param part_image: returns the image of a part
+        :param part_position: the part boxes in canvas coordinates
+        :param cache_size: bytes of intermediate composites to keep
+        :param cache: cache to put the intermediate composites in, its keys are tuples of part indexes,
+            `cache_size` is then not used
+        """
+        self.part_image = part_image
+        self.part_position = part_position
+        self._cache = cache if cache is not None else _ImageCache(cache_size)
+
+    def compose(self, parts: list[int]) -> tuple[Image.Image, tuple]:
+        """
+        compose parts bottom to top
+
+        :param parts: part indexes, bottom first
+        :return: (image, box in canvas coordinates)
+        """
+        parts = tuple(parts)
+        with stats.stage("lay.compose") as stage:
+            image, box = self._compose(parts)
+            if stage:
+                stage.bytes_out = image.width * image.height * 4
+        return image, box
+
+    def _compose(self, parts: tuple) -> tuple[Image.Image, tuple]:
+
+        # longest cached prefix, the whole stack is never cached
+        image, box, start = None, None, 0
+        for length in range(len(parts) - 1, 0, -1):
+            cached = self._cache.get(parts[:length])
+            if cached is not None:
+                image, box = cached
+                start = length
+                break
+
+        # only the remaining parts are drawn
+        for length in range(start + 1, len(parts) + 1):
+            image, box = self._layer(image, box, parts[length - 1])
+            if length < len(parts):
+                self._cache.put(parts[:length], (image, box))
+
+        if image is None:
+            raise ValueError("no part to compose")
+        return image, box
+
+    def _layer(self, base: Image.Image | None, base_box: tuple | None, part: int) -> tuple[Image.Image, tuple]:
+        part_image = self.part_image(part)
+        part_box = self.part_position[part]
+
+        if base_box is None:
+            box = part_box
+        else:
+            box = (
+                min(base_box[0], part_box[0]),
+                min(base_box[1], part_box[1]),
+                max(base_box[2], part_box[2]),
+                max(base_box[3], part_box[3]),
+            )
+
+        if base is not None and box == base_box:
+            canvas = base.copy()
+        else:
+            canvas = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]))
+            if base is not None:
+                canvas.paste(base, (base_box[0] - box[0], base_box[1] - box[1]))
+        canvas.paste(part_image, (part_box[0] - box[0], part_box[1] - box[1]), part_image)
+        return canvas, box
+
+
+class _ImageCache:
+    """
+    LRU cache bounded by the bytes of the images it holds, values are images or (image, ...) tuples
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def _sizeof(value) -> int:
+        image = value[0] if isinstance(value, tuple) else value
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.size:
             return
 
-        # compose image by path
-        compose_path = [-1] * 7
-        last = -1
+        if key in self._items:
+            self._bytes -= self._sizeof(self._items.pop(key))
+        self._items[key] = value
+        self._bytes += size
+        while self._bytes > self.size:
+            _, evicted = self._items.popitem(last=False)
+            self._bytes -= self._sizeof(evicted)
 
-        i_image = 0
-        for i_part in range(part_count + 1):
-            # path meets end
-            if i_part >= part_count or int(compose_tree[i_part][3] / 0x10) <= last:
-                canvas = Image.new("RGBA", CANVAS_SIZE)
-                # crop image
-                min_x, min_y, max_x, max_y = canvas.size[0], canvas.size[1], 0, 0
-
-                # composing
-                for i_path in range(last + 1):
-                    if compose_path[i_path] != -1:
-                        x, y, a, b = part_position[compose_path[i_path]]
-                        min_x = min(min_x, x)
-                        min_y = min(min_y, y)
-                        max_x = max(max_x, a)
-                        max_y = max(max_y, b)
-                        canvas.paste(
-                            part_images[compose_path[i_path]],
-                            (x, y),
-                            part_images[compose_path[i_path]],
-                        )
-                cropped_image = canvas.crop((min_x, min_y, max_x, max_y))
-                cropped_image.save(composed_folder / (str(i_image) + ".png"))
-                i_image += 1
-
-            # iter tree by DFS
-            if i_part < part_count:
-                last = int(compose_tree[i_part][3] / 0x10)
-                compose_path[last] = i_part
+
+def _read_tiles(lay_data: bytes, offset: int, count: int):
+    """
+    Read the tile table
+
+    :param lay_data: decompressed lay data
+    :param offset: offset of the tile table
+    :param count: number of tiles
+
+    :return: (count, 4) int array, or list of tuples without numpy, of canvas x, canvas y, source x, source y
+    """
+    if np is not None:
+        tiles = np.frombuffer(lay_data, dtype="<f4", count=count * 4, offset=offset).reshape(count, 4)
+        tiles = tiles.astype(np.float64)
+        # part position relative to image center
+        tiles[:, 0] += CANVAS_SIZE[0] / 2
+        tiles[:, 1] += CANVAS_SIZE[1] / 2
+        # truncate like int()
+        return tiles.astype(np.int64)
+
+    tiles = []
+    for part_x, part_y, source_x, source_y in struct.iter_unpack("<4f", lay_data[offset : offset + count * 16]):
+        # part position relative to image center
+        part_x += CANVAS_SIZE[0] / 2
+        part_y += CANVAS_SIZE[1] / 2
+        tiles.append((int(part_x), int(part_y), int(source_x), int(source_y)))
+    return tiles
+
+
+def _part_box(tiles) -> tuple[int, int, int, int]:
+    if not len(tiles):
+        return CANVAS_SIZE[0], CANVAS_SIZE[1], DRAW_TILE_SIZE, DRAW_TILE_SIZE
+
+    if np is not None:
+        min_x, min_y = (int(i) for i in tiles[:, :2].min(axis=0))
+        max_x, max_y = (int(i) for i in tiles[:, :2].max(axis=0))
+    else:
+        min_x, min_y = min(tile[0] for tile in tiles), min(tile[1] for tile in tiles)
+        max_x, max_y = max(tile[0] for tile in tiles), max(tile[1] for tile in tiles)
+    return min_x, min_y, max_x + DRAW_TILE_SIZE, max_y + DRAW_TILE_SIZE
+
+
+def _source_array(source_image: Image.Image):
+    # RGBA pixels, and the colour a crop reads outside the image
+    fill = source_image.crop((-1, -1, 0, 0)).convert("RGBA").getpixel((0, 0))
+    if source_image.mode != "RGBA":
+        source_image = source_image.convert("RGBA")
+    return np.asarray(source_image), fill
+
+
+def _blit_tiles(source, fill, tiles, box) -> Image.Image:
+    canvas = np.zeros((box[3] - box[1], box[2] - box[0], 4), np.uint8)
+    height, width = source.shape[:2]
+    size = SOURCE_TILE_SIZE
+
+    # slice copies of whole tiles, later tiles overwrite earlier ones like paste
+    for x, y, source_x, source_y in (tiles - (box[0], box[1], 1, 1)).tolist():
+        if 0 <= source_x <= width - size and 0 <= source_y <= height - size:
+            canvas[y : y + size, x : x + size] = source[source_y : source_y + size, source_x : source_x + size]
+            continue
+
+        # partly outside the source
+        target = canvas[y : y + size, x : x + size]
+        target[:] = fill
+        left, top = max(source_x, 0), max(source_y, 0)
+        right, bottom = min(source_x + size, width), min(source_y + size, height)
+        if left < right and top < bottom:
+            target[top - source_y : bottom - source_y, left - source_x : right - source_x] = source[top:bottom, left:right]
+    return Image.fromarray(canvas)
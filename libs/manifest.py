@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+from os import PathLike
+from pathlib import Path
+
+MANIFEST_NAME = ".cctools-manifest.json"
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_bytes(data) -> str:
+    """
+    fast content hash of a buffer
+
+    :param data: bytes-like object
+    :return: hex digest
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_file(file: PathLike | str) -> str:
+    """
+    fast content hash of a file, read in chunks
+
+    :param file: file path
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with Path(file).open("rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_state(file: PathLike | str, previous: dict | None = None) -> dict:
+    """
+    size, mtime and content hash of a file
+
+    The file is only hashed again when its size or mtime differs from `previous`.
+
+    :param file: file path
+    :param previous: the state recorded last time
+    :return: {"size", "mtime_ns", "hash"}
+    """
+    stat = Path(file).stat()
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return previous
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": hash_file(file)}
+
+
+class Manifest:
+    """
+    The inputs of the previous runs, stored in the output folder
+
+    Entries are keyed by the command and the source, they hold the target and the states of the input files.
+    """
+
+    def __init__(self, folder: PathLike | str):
+        """
+        :param folder: output folder
+        """
+        self.path = Path(folder) / MANIFEST_NAME
+        self.entries: dict[str, dict] = {}
+
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+            except ValueError:
+                # broken manifest, everything is extracted again
+                data = {}
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("entries", {})
+
+    @staticmethod
+    def key(command: str, source: PathLike | str) -> str:
+        return command + ":" + str(Path(source).resolve())
+
+    def get(self, key: str) -> dict | None:
+        return self.entries.get(key)
+
+    def input_states(self, key: str, inputs: list[Path]) -> dict[str, dict]:
+        """
+        get the states of the input files of an entry, unchanged files are not hashed again
+
+        :param key: entry key
+        :param inputs: input files
+        :return: {path: state}
+        """
+        previous = (self.get(key) or {}).get("inputs", {})
+        return {str(i): file_state(i, previous.get(str(i))) for i in inputs}
+
+    def unchanged(self, key: str, target: Path, states: dict[str, dict]) -> bool:
+        """
+        check if an entry was done with the same inputs and its target still exists
+
+        :param key: entry key
+        :param target: output path
+        :param states: current input states
+        :return: True if the work can be skipped
+        """
+        entry = self.get(key)
+        if entry is None or entry.get("target") != str(target) or not target.exists():
+            return False
+        previous = entry.get("inputs", {})
+        return previous.keys() == states.keys() and all(previous[i]["hash"] == states[i]["hash"] for i in states)
+
+    def record(self, key: str, target: Path, states: dict[str, dict], **extra):
+        """
+        record a finished entry
+
+        :param key: entry key
+        :param target: output path
+        :param states: input states
+        :param extra: other values kept with the entry
+        :return: None
+        """
+        self.entries[key] = {"target": str(target), "inputs": states, **extra}
+
+    def save(self):
+        # write a temporary file first, an interrupted save keeps the old manifest
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        temp_path.write_text(json.dumps({"version": MANIFEST_VERSION, "entries": self.entries}), encoding="utf-8")
+        os.replace(temp_path, self.path)
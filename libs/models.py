@@ -1,8 +1,16 @@
 import struct
-from collections.abc import Buffer
+from array import array
+from collections.abc import Buffer, Sequence
+
+MPK_FILE_INFO_SIZE = 0x100
+ZLIB_HEADERS = (b"\x78\x5e", b"\x78\x9c")
+TEXTURE_TYPE_SWIZZLED = 0x00000000
+TEXTURE_TYPE_LINEAR = 0x60000000
 
 
 class MPKFileInfo:
+    __slots__ = ("_flag", "_index", "_offset", "_size", "_name")
+
     _flag: bool
     _index: int
     _offset: int
@@ -68,3 +76,127 @@ class MPKFileInfo:
             # unpacked[4]
             name=unpacked[5].decode("shift_jis").strip("\x00")
         )
+
+
+class MPKFileTable(Sequence):
+    """
+    The file table of a mpk file, kept as compact arrays
+
+    Items are created on access, the Shift-JIS names are only decoded when they are needed.
+    """
+
+    __slots__ = ("_flags", "_indexes", "_offsets", "_sizes", "_names", "_name_ends")
+
+    def __init__(self, table: Buffer):
+        self._flags = array("B")
+        self._indexes = array("I")
+        self._offsets = array("Q")
+        self._sizes = array("Q")
+        self._name_ends = array("Q")
+
+        # raw names packed in one buffer, decoded on access
+        names = bytearray()
+        for flag, index, offset, size, _, name in struct.iter_unpack("?I3Q224s", table):
+            self._flags.append(flag)
+            self._indexes.append(index)
+            self._offsets.append(offset)
+            self._sizes.append(size)
+            names += name.rstrip(b"\x00")
+            self._name_ends.append(len(names))
+        self._names = bytes(names)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("file table index out of range")
+
+        return MPKFileInfo(
+            flag=bool(self._flags[item]),
+            index=self._indexes[item],
+            offset=self._offsets[item],
+            size=self._sizes[item],
+            name=self.name(item),
+        )
+
+    def name(self, item: int) -> str:
+        """
+        get the name of an entry without building the MPKFileInfo
+
+        :param item: position in the table
+        :return: decoded name
+        """
+        start = self._name_ends[item - 1] if item > 0 else 0
+        return self._names[start : self._name_ends[item]].decode("shift_jis").strip("\x00")
+
+    @property
+    def offsets(self) -> array:
+        return self._offsets
+
+    @property
+    def sizes(self) -> array:
+        return self._sizes
+
+
+class GxtHeader:
+    def __init__(self, data):
+        # check if a valid GXT file
+        if data[0:4] != b"GXT\x00":
+            raise ValueError("Invalid GXT header, maybe not a GXT file")
+
+        # check if a supported version
+        self.ver = struct.unpack("2H", data[4:8])
+        if self.ver != (3, 0x1000):
+            raise ValueError("Unsupported GXT version")
+
+        (
+            self.textures_count,
+            self.texture_offset,
+            self.texture_size,
+            self.palette_4_len,
+            self.palette_8_len,
+            self.Padding,
+        ) = struct.unpack("6I", data[8:0x20])
+
+        if self.palette_4_len != 0 or self.palette_8_len != 1:
+            raise ValueError("Unsupported palette length")
+
+    def get_offset(self):
+        return self.texture_offset
+
+    def get_palette_offset(self):
+        return (
+            self.texture_offset
+            + self.texture_size
+            - (self.palette_4_len * 0x40 + self.palette_8_len * 0x400)
+        )
+
+
+class GxtTextureInfo:
+    def __init__(self, data, check_format=True):
+        (
+            self.offset,
+            self.size,
+            self.palette_index,
+            self.flags,
+            self.texture_type,
+            self.texture_format,
+        ) = struct.unpack("6I", data[:24])
+
+        self.width, self.height = struct.unpack("2H", data[24:28])
+
+        # P8_ARGB
+        if check_format and self.texture_format != 0x95001000:
+            raise ValueError("Unsupported texture format, expected 0x95001000, got {}".format(hex(self.texture_format)))
+
+
+def cstr(s):
+    p = "{}s".format(len(s))
+    s = struct.unpack(p, s)[0]
+    return str(s.replace(b"\x00", b""), encoding="sjis")
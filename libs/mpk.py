@@ -1,16 +1,27 @@
+import io
+import mmap
+import os
 import struct
 from os import PathLike
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from .models import MPKFileInfo
+from . import stats
+from .models import MPK_FILE_INFO_SIZE, MPKFileInfo, MPKFileTable
 
+if TYPE_CHECKING:
+    from .dedup import BlobStore
 
-def get_files_info_in_mpk(file: PathLike | str) -> list[MPKFileInfo]:
+# upper bound of member bytes buffered in python memory per worker
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def get_files_info_in_mpk(file: PathLike | str) -> MPKFileTable:
     """
     get files info in mpk file
 
     :param file: mpk file path
-    :return: list of MPKFileInfo
+    :return: MPKFileTable, a sequence of MPKFileInfo
     """
     mpk_path = Path(file)
 
@@ -18,30 +29,264 @@ def get_files_info_in_mpk(file: PathLike | str) -> list[MPKFileInfo]:
         raise FileNotFoundError(f"cannot find {file}")
 
     with mpk_path.open("rb") as mpk_file:
-        # check if the file is a mpk file
-        data = struct.unpack("4c", mpk_file.read(4))
-        if data != (b"M", b"P", b"K", b"\x00"):
-            raise ValueError("unknown file type!")
+        return _read_files_info(mpk_file)
+
+
+def _read_files_info(mpk_file) -> MPKFileTable:
+    # check if the file is a mpk file
+    data = struct.unpack("4c", mpk_file.read(4))
+    if data != (b"M", b"P", b"K", b"\x00"):
+        raise ValueError("unknown file type!")
+
+    _, file_count = struct.unpack("<2I", mpk_file.read(8))
+    mpk_file.read(0x34)
+
+    # read the whole file table at once
+    with stats.stage("mpk.table", file_count * MPK_FILE_INFO_SIZE, file_count):
+        return MPKFileTable(mpk_file.read(file_count * MPK_FILE_INFO_SIZE))
+
+
+class MpkMemberReader(io.RawIOBase):
+    """
+    Read-only file object over a member of a mpk archive, reads come straight from the mapped archive
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        self._checkClosed()
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        data = bytes(self._view[self._position : end])
+        self._position = max(self._position, end)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+        self._position = position
+        return position
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+class MpkArchive:
+    """
+    Random access to the members of a mpk file
+
+    The archive is memory-mapped once and its table is parsed once, members are looked up by name.
+    """
+
+    def __init__(self, file: PathLike | str):
+        """
+        :param file: mpk file path
+        """
+        self.path = Path(file)
+
+        if not self.path.exists():
+            raise FileNotFoundError(f"cannot find {file}")
+
+        with self.path.open("rb") as mpk_file:
+            self._mmap = mmap.mmap(mpk_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.files = _read_files_info(self._mmap)
+        self._names: dict[str, int] | None = None
+
+    def __enter__(self) -> "MpkArchive":
+        return self
 
-        _, file_count = struct.unpack("<2I", mpk_file.read(8))
-        mpk_file.read(0x34)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        # index table
-        files: list[MPKFileInfo] = []
+    def __len__(self) -> int:
+        return len(self.files)
 
-        # read file table
-        for i in range(file_count):
-            files.append(MPKFileInfo.unpack(mpk_file.read(0x100)))
+    def __iter__(self):
+        return iter(self.files)
 
-        return files
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
 
+    @property
+    def names(self) -> dict[str, int]:
+        """
+        name to table position index, built on first lookup
+        """
+        if self._names is None:
+            self._names = {self.files.name(i): i for i in range(len(self.files))}
+        return self._names
 
-def unpack_mpk(file: PathLike | str, unpack_folder: PathLike | str | None = None):
+    def close(self):
+        """
+        Close the archive, the mapping stays alive until the views handed out are released
+        """
+        if self._mmap is None:
+            return
+        try:
+            self._mmap.close()
+        except BufferError:
+            # members still referenced, unmapped when they are collected
+            pass
+        self._mmap = None
+
+    def getinfo(self, name: str) -> MPKFileInfo:
+        """
+        get file info of a member
+
+        :param name: member name
+        :return: MPKFileInfo
+        """
+        try:
+            return self.files[self.names[name]]
+        except KeyError:
+            raise KeyError(f"cannot find {name} in {self.path}") from None
+
+    def view(self, member: MPKFileInfo | str) -> memoryview:
+        """
+        get the content of a member without copying it
+
+        :param member: member name or MPKFileInfo
+        :return: read-only memoryview of the member
+        """
+        if self._mmap is None:
+            raise ValueError("I/O operation on closed archive")
+        file_info = self.getinfo(member) if isinstance(member, str) else member
+        return memoryview(self._mmap)[file_info.offset : file_info.offset + file_info.size]
+
+    def read(self, member: MPKFileInfo | str) -> bytes:
+        """
+        get the content of a member
+
+        :param member: member name or MPKFileInfo
+        :return: bytes of the member
+        """
+        with self.view(member) as view:
+            return bytes(view)
+
+    def open(self, member: MPKFileInfo | str) -> MpkMemberReader:
+        """
+        open a member as a file object, e.g. for `Image.open`
+
+        :param member: member name or MPKFileInfo
+        :return: MpkMemberReader
+        """
+        return MpkMemberReader(self.view(member))
+
+
+def _copy_member(mpk_path: Path, mpk_fd: int, file_info: MPKFileInfo, target_file: Path):
+    with stats.stage("mpk.copy", file_info.size) as stage:
+        _copy_range(mpk_path, mpk_fd, file_info, target_file)
+        if stage:
+            stage.bytes_out = file_info.size
+
+
+def _copy_range(mpk_path: Path, mpk_fd: int, file_info: MPKFileInfo, target_file: Path):
+    offset, size = file_info.offset, file_info.size
+
+    # a file linked to another one by dedup is replaced, not written through
+    target_file.unlink(missing_ok=True)
+    with target_file.open("wb") as out:
+        # let the kernel copy the range, no member bytes go through python
+        if hasattr(os, "copy_file_range"):
+            try:
+                while size > 0:
+                    copied = os.copy_file_range(mpk_fd, out.fileno(), size, offset)
+                    if copied == 0:
+                        return
+                    offset += copied
+                    size -= copied
+                return
+            except OSError:
+                # not supported by the file systems, finish the copy below
+                pass
+
+        # positional reads on the shared descriptor, safe across threads
+        if hasattr(os, "pread"):
+            while size > 0:
+                chunk = os.pread(mpk_fd, min(size, COPY_CHUNK_SIZE), offset)
+                if not chunk:
+                    return
+                out.write(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+            return
+
+        # no positional io, use a private handle
+        with mpk_path.open("rb") as mpk_file:
+            mpk_file.seek(offset)
+            while size > 0:
+                chunk = mpk_file.read(min(size, COPY_CHUNK_SIZE))
+                if not chunk:
+                    return
+                out.write(chunk)
+                size -= len(chunk)
+
+
+def _hash_members(mpk_path: Path, jobs: int) -> tuple[list[MPKFileInfo], list[str]]:
+    from .manifest import hash_bytes
+
+    with MpkArchive(mpk_path) as archive:
+        files = list(archive)
+
+        def hash_member(file_info: MPKFileInfo) -> str:
+            with archive.view(file_info) as view:
+                return hash_bytes(view)
+
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                hashes = list(executor.map(hash_member, files))
+        else:
+            hashes = [hash_member(file_info) for file_info in files]
+    return files, hashes
+
+
+def unpack_mpk(
+    file: PathLike | str,
+    unpack_folder: PathLike | str | None = None,
+    jobs: int = 1,
+    member_hashes: dict[str, str] | None = None,
+    store: "BlobStore | None" = None,
+):
     """
     unpack mpk file
 
     :param file: mpk file path
-    :param unpack_folder: unpacked folder path
+    :param unpack_folder: unpacked folder path, defaults to a folder named after the mpk file
+    :param jobs: number of members copied at the same time
+    :param member_hashes: member name to content hash of the last unpack, when given only the members that changed
+        or whose file is missing are written, and the dict is updated with the current hashes
+    :param store: when given, members with the same content as a file written before are linked to it
     :return: None
     """
     mpk_path = Path(file)
@@ -49,18 +294,52 @@ def unpack_mpk(file: PathLike | str, unpack_folder: PathLike | str | None = None
     if not mpk_path.exists():
         raise FileNotFoundError(f"cannot find {file}")
 
-    files = get_files_info_in_mpk(mpk_path)
+    if unpack_folder:
+        unpack_folder = Path(unpack_folder)
+    else:
+        unpack_folder = mpk_path.parent / mpk_path.stem
+
+    if member_hashes is not None or store is not None:
+        files, hashes = _hash_members(mpk_path, jobs)
+    else:
+        files, hashes = get_files_info_in_mpk(mpk_path), None
+
+    if member_hashes is not None:
+        members = [
+            (file_info, digest)
+            for file_info, digest in zip(files, hashes)
+            if member_hashes.get(file_info.name) != digest or not (unpack_folder / file_info.name).exists()
+        ]
+
+        # members removed from the archive are forgotten
+        member_hashes.clear()
+        member_hashes.update((file_info.name, digest) for file_info, digest in zip(files, hashes))
+        files, hashes = [file_info for file_info, _ in members], [digest for _, digest in members]
+
+    targets = [unpack_folder / file_info.name for file_info in files]
+
+    # create the directory tree once
+    for target_folder in {target.parent for target in targets}:
+        target_folder.mkdir(parents=True, exist_ok=True)
 
     with mpk_path.open("rb") as mpk_file:
-        for file_info in files:
-            target_folder = unpack_folder / Path(file_info.name).parent
+        mpk_fd = mpk_file.fileno()
 
-            # create subdirectory
-            if not target_folder.exists():
-                target_folder.mkdir(parents=True)
+        def copy(item):
+            file_info, target_file, digest = item
+            if store is None:
+                _copy_member(mpk_path, mpk_fd, file_info, target_file)
+            else:
+                store.place(target_file, digest, file_info.size, lambda path: _copy_member(mpk_path, mpk_fd, file_info, path))
 
-            mpk_file.seek(file_info.offset)
+        items = zip(files, targets, hashes or [None] * len(files))
+        if jobs > 1:
+            # imported on use, it is slow to import and most commands do not need it
+            from concurrent.futures import ThreadPoolExecutor
 
-            target_file = target_folder / Path(file_info.name).name
-            with target_file.open("wb") as out:
-                out.write(mpk_file.read(file_info.size))
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                # consume the results to raise the first error
+                list(executor.map(copy, items))
+        else:
+            for item in items:
+                copy(item)
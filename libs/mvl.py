@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
+from os import PathLike
+from pathlib import Path
+
 from PIL import Image
 
+import json
 import zlib
 import struct, os
 
+from . import gxt  # registers the GXT plugin for the pictures
+from . import stats
+from .atlas import render_atlas
+from .models import cstr
+from .output import ImageWriter, write_bytes
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, fall back to struct per vertex
+    np = None
+
+# the layers are placed on a canvas of this size, centered on the origin
+CANVAS_SIZE = (4000, 2000)
+
 
 class Mvl:
     """
@@ -21,6 +39,10 @@ class Mvl:
     """
 
     def __init__(self, data):
+        with stats.stage("mvl.parse", len(data)):
+            self.parse(data)
+
+    def parse(self, data):
         if data.startswith(b"\x78\x9c"):
             data = zlib.decompress(data)
         self.data = data
@@ -54,6 +76,10 @@ class Mvl:
         self.get_blocks()
 
     def get_blocks(self):
+        if np is not None:
+            self.get_blocks_numpy()
+            return
+
         for i in range(self.n):
             tmp = self.pic[i]
             bi = tmp["first_block"]
@@ -73,7 +99,39 @@ class Mvl:
 
             self.pic[i]["block"] = blocks
 
+    def get_blocks_numpy(self):
+        # same as get_blocks, block is a (length, 5) float64 array of rounded x, y, z and u, v
+        for i in range(self.n):
+            tmp = self.pic[i]
+            bi = tmp["first_block"]
+            bl = tmp["block_len"]
+
+            vertices = np.frombuffer(self.data, dtype="<f4", count=bl * 5, offset=bi).reshape(bl, 5)
+            indexes = np.frombuffer(self.data, dtype="<u2", count=tmp["length"], offset=tmp["index"])
+            if len(indexes) and indexes.max() >= bl:
+                raise AssertionError("out blocks %d" % (int(np.argmax(indexes >= bl)) * 2))
+
+            # points and UV
+            blocks = vertices[indexes].astype(np.float64)
+            assert not blocks[:, 2].any(), "z!=0"
+            blocks[:, :3] = f2int_array(blocks[:, :3])
+
+            self.pic[i]["block"] = blocks
+
     def combine(self, pic):
+        ret = {}
+        for name, metadata, image in self.iter_layers(pic):
+            metadata["image"] = image
+            ret[name] = metadata
+        return ret
+
+    def iter_layers(self, pic):
+        """
+        combine the layers one at a time, each layer only allocates its own bounding box
+
+        :param pic: the picture paired with the mvl file
+        :return: generator of (name, {"min_x", "min_y", "max_x", "max_y"}, RGBA image)
+        """
         w, h = pic.size
         block = self.pic[0]["block"]
         dx = abs(block[0][0] - block[1][0])
@@ -81,40 +139,56 @@ class Mvl:
         dw = abs(block[0][3] - block[1][3]) * w
         dh = abs(block[0][4] - block[2][4]) * h
         rx, ry = dx / dw, dy / dh
-        pic_i = 0
-        ret = {}
+
+        # convert once, tiles reaching out of the picture are still cropped and converted one by one
+        source = pic if pic.mode == "RGBA" else pic.convert("RGBA")
         for i in self.pic:
             if i["length"] <= 0:
                 continue
-            img = Image.new(size=(4000, 2000), mode="RGBA", color="#00000000")
             name = i["name"]
-            point = i["block"][0]
-
-            x, y = (point[0] / rx + 2000, point[1] / ry + 1000)
-            min_x, max_x, min_y, max_y = (x, y, x, y)
-            # step ever two triangles
-            for j in range(0, len(i["block"]), 6):
-                point = i["block"][j]
-                # resize to orignal
-                x, y = (point[0] / rx + 2000, point[1] / ry + 1000)
-                cp = pic.crop(
-                    (point[3] * w, point[4] * h, point[3] * w + dw, point[4] * h + dh)
-                ).convert("RGBA")
-                img.paste(cp, (f2int(x), f2int(y)), mask=cp)
-                min_x = min(x, min_x)
-                max_x = max(x, max_x)
-                min_y = min(y, min_y)
-                max_y = max(y, max_y)
-            max_x += dw
-            max_y += dh
-            ret[name] = {
+
+            with stats.stage("mvl.combine") as stage:
+                # step ever two triangles, resize to orignal
+                points = [i["block"][j] for j in range(0, len(i["block"]), 6)]
+                xs = [point[0] / rx + CANVAS_SIZE[0] / 2 for point in points]
+                ys = [point[1] / ry + CANVAS_SIZE[1] / 2 for point in points]
+
+                # the bounds start from (x, y, x, y) of the first point as min_x, max_x, min_y, max_y
+                min_x = min(xs[0], *xs)
+                max_x = max(ys[0], *xs) + dw
+                min_y = min(xs[0], *ys)
+                max_y = max(ys[0], *ys) + dh
+                box = tuple(int(round(float(v))) for v in (min_x, min_y, max_x, max_y))
+
+                img = Image.new(size=(box[2] - box[0], box[3] - box[1]), mode="RGBA", color="#00000000")
+                for point, x, y in zip(points, xs, ys):
+                    crop_box = (point[3] * w, point[4] * h, point[3] * w + dw, point[4] * h + dh)
+                    if all(0 <= round(float(v)) <= size for v, size in zip(crop_box, (w, h, w, h))):
+                        cp = source.crop(crop_box)
+                    else:
+                        cp = pic.crop(crop_box).convert("RGBA")
+                    _paste_clipped(img, cp, (f2int(x), f2int(y)), box)
+                if stage:
+                    stage.bytes_out = img.width * img.height * 4
+
+            yield name, {
                 "min_x": f2int((min_x - 1000) * rx),
                 "min_y": f2int((min_y - 1000) * ry),
                 "max_x": f2int((max_x - 1000) * rx),
                 "max_y": f2int((max_y - 1000) * ry),
-                "image": img.crop((min_x, min_y, max_x, max_y)),
-            }
-        return ret
+            }, img
+
+
+def _paste_clipped(img, tile, position, box):
+    # paste a tile at canvas position into img covering box of the canvas, dropping what falls off the canvas
+    x, y = position
+    clip = (max(0, -x), max(0, -y), min(tile.width, CANVAS_SIZE[0] - x), min(tile.height, CANVAS_SIZE[1] - y))
+    if clip[0] >= clip[2] or clip[1] >= clip[3]:
+        return
+    if clip != (0, 0, tile.width, tile.height):
+        tile = tile.crop(clip)
+        x, y = x + clip[0], y + clip[1]
+    img.paste(tile, (x - box[0], y - box[1]), mask=tile)
 
 
 def f2int(x):
@@ -123,60 +197,134 @@ def f2int(x):
     return int(x)
 
 
+def f2int_array(x):
+    """
+    f2int of every item
+
+    :param x: float array
+    :return: float array of the rounded values
+    """
+    t = np.trunc(x)
+    return np.where(np.abs(t - x) > 0.5, np.trunc(x + 0.5), t)
+
+
 def find_filename(filename):
+    filename = str(filename)
     if filename.endswith("_.mvl"):
         name = filename[:-5] + ".png"
         if os.path.exists(name):
             return (filename, name)
         else:
-            import gxt
-
+            # decoded by the GXT plugin
             return (filename, filename[:-5] + ".gxt")
     elif filename.endswith(".png"):
         return (filename[:-4] + "_.mvl", filename)
     elif filename.endswith(".gxt"):
-        import gxt
-
         return (filename[:-4] + "_.mvl", filename)
     return (filename, filename[:-4] + ".png")
 
 
-def cstr(s):
-    p = "{}s".format(len(s))
-    s = struct.unpack(p, s)[0]
-    return str(s.replace(b"\x00", b""), encoding="sjis")
-
-
 def process_data(mvl_data, pic):
     mvl = Mvl(mvl_data)
     return mvl.combine(pic)
 
 
-def main():
-    import argparse
+def render_mvl_images(mvl_data, pic, suffix=".png", atlas=False):
+    """
+    combine the layers of a mvl file in memory
+
+    :param mvl_data: mvl file content, zlib compressed or not
+    :param pic: the picture paired with the mvl file
+    :param suffix: extension of the layer files, other than ".png" it is written in index.json for the viewer
+    :param atlas: pack the layers into atlas images, index.json is then {"atlas": pages, "layers": {name: box and rect}}
+
+    :return: generator of (file name, image), then ("index.json", json bytes)
+    """
+    if atlas:
+        yield from _render_mvl_atlas(mvl_data, pic, suffix)
+        return
+
+    data = {}
+    for name, metadata, image in Mvl(mvl_data).iter_layers(pic):
+        if suffix != ".png":
+            metadata["file"] = name + suffix
+        data[name] = metadata
+        yield name + suffix, image
+
+    yield "index.json", json.dumps(data).encode()
 
-    parser = argparse.ArgumentParser("python3 mvl.py")
-    parser.add_argument("filename")
-    args = parser.parse_args()
-    mvl, pic = find_filename(args.filename)
 
-    with open(mvl, "rb") as f:
+def _render_mvl_atlas(mvl_data, pic, suffix):
+    layers = {}
+    images = []
+    for name, metadata, image in Mvl(mvl_data).iter_layers(pic):
+        layers[name] = metadata
+        images.append(image)
+
+    index, rects, pages = render_atlas(images, suffix)
+    yield from pages
+    for metadata, rect in zip(layers.values(), rects):
+        metadata.update(rect)
+    yield "index.json", json.dumps({"atlas": index, "layers": layers}).encode()
+
+
+def extract_mvl_image(
+    file: PathLike | str,
+    extract_folder: PathLike | str | None = None,
+    writer: ImageWriter | None = None,
+    atlas=False,
+):
+    """
+    combine the layers of a mvl file, a gxt picture is decoded in memory
+
+    :param file: mvl/png/gxt file path
+    :param extract_folder: folder to extract the layers and index.json, defaults to a folder named after the picture
+    :param writer: output format of the layers, PNG by default
+    :param atlas: pack the layers into a few atlas images
+
+    :return: None
+    """
+    mvl_path, pic_path = (Path(i) for i in find_filename(file))
+
+    # check if the files exist
+    if not mvl_path.exists():
+        raise FileNotFoundError(f"cannot find {mvl_path}")
+    if not pic_path.exists():
+        raise FileNotFoundError(f"cannot find {pic_path}")
+
+    if extract_folder:
+        extract_folder = Path(extract_folder)
+    else:
+        extract_folder = mvl_path.parent / mvl_path.name[:-5]
+    extract_folder.mkdir(parents=True, exist_ok=True)
+
+    with mvl_path.open("rb") as f:
         mvl_data = f.read()
-    pic = Image.open(pic)
 
-    dir = mvl[:-5]
-    if not os.path.exists(dir):
-        os.mkdir(dir)
-    data = process_data(mvl_data, pic)
-    for i in data:
-        data[i]["image"].save(dir + "/" + i + ".png")
+    owned = writer is None
+    writer = writer or ImageWriter()
+    try:
+        with Image.open(pic_path, formats=["PNG", "GXT"]) as pic:
+            for name, output in render_mvl_images(mvl_data, pic, writer.suffix, atlas):
+                if isinstance(output, bytes):
+                    write_bytes(extract_folder / name, output)
+                else:
+                    writer.save(output, extract_folder / name)
+    finally:
+        # wait for the background writes of this file, a writer built here also stops its threads
+        if owned:
+            writer.close()
+        else:
+            writer.flush()
+
 
-    for i in data:
-        del data[i]["image"]
-    import json
+def main():
+    import argparse
 
-    with open(dir + "/index.json", "w") as f:
-        json.dump(data, f)
+    parser = argparse.ArgumentParser("python3 -m libs.mvl")
+    parser.add_argument("filename")
+    args = parser.parse_args()
+    extract_mvl_image(args.filename)
 
 
 if __name__ == "__main__":
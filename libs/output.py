@@ -0,0 +1,223 @@
+import io
+import struct
+import threading
+from functools import lru_cache
+from os import PathLike
+from pathlib import Path
+
+from PIL import Image
+
+from . import stats
+
+# format name to file extension
+OUTPUT_FORMATS = {"png": ".png", "webp": ".webp", "raw": ".raw"}
+
+# raw dump: magic, mode, width, height, palette size, then the palette and the pixels
+RAW_MAGIC = b"CCRAW\x00\x00\x00"
+RAW_HEADER = struct.Struct("<8s8s3I")
+
+
+def write_raw(image: Image.Image, fp):
+    """
+    dump the pixels of an image without compression, the palette of a "P" image is kept
+
+    :param image: the image
+    :param fp: binary file object
+    :return: None
+    """
+    palette = bytes(image.getpalette("RGBA")) if image.mode == "P" else b""
+    fp.write(RAW_HEADER.pack(RAW_MAGIC, image.mode.encode(), image.width, image.height, len(palette)))
+    fp.write(palette)
+    fp.write(image.tobytes())
+
+
+def write_bytes(target: PathLike | str, data: bytes):
+    """
+    write a file, a file linked to another one by dedup is replaced, not written through
+
+    :param target: file path
+    :param data: content
+    :return: None
+    """
+    target = Path(target)
+    target.unlink(missing_ok=True)
+    target.write_bytes(data)
+
+
+def read_raw(file: PathLike | str) -> Image.Image:
+    """
+    load an image written by `write_raw`
+
+    :param file: raw file path
+    :return: the image
+    """
+    data = Path(file).read_bytes()
+    magic, mode, width, height, palette_size = RAW_HEADER.unpack_from(data)
+    if magic != RAW_MAGIC:
+        raise ValueError("not a raw image dump")
+
+    mode = mode.rstrip(b"\x00").decode()
+    pixels = memoryview(data)[RAW_HEADER.size + palette_size :]
+    image = Image.frombuffer(mode, (width, height), pixels, "raw", mode, 0, 1)
+    if palette_size:
+        image.putpalette(data[RAW_HEADER.size : RAW_HEADER.size + palette_size], "RGBA")
+    return image
+
+
+class ImageWriter:
+    """
+    Encode and write output images in one format, optionally on a thread pool
+
+    Pillow releases the GIL while compressing, so decoding goes on while the images are encoded.
+    The pool is created on first use. A pickled writer is loaded as the writer of its settings shared by the
+    whole process, so the tasks sent to a worker process use one pool.
+    """
+
+    def __init__(self, format: str = "png", png_level: int | None = None, jobs: int = 0):
+        """
+        :param format: "png", "webp" (lossless) or "raw" (uncompressed dump, see `write_raw`)
+        :param png_level: zlib level of png files, 0-9, None for the Pillow default
+        :param jobs: number of encoding threads, 0 to encode in the calling thread
+        """
+        if format not in OUTPUT_FORMATS:
+            raise ValueError(f"unknown output format {format}")
+        if png_level is not None and not 0 <= png_level <= 9:
+            raise ValueError("png level must be between 0 and 9")
+        self.format = format
+        self.png_level = png_level
+        self.jobs = jobs
+        self._executor = None
+        self._futures = []
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return shared_writer, (self.format, self.png_level, self.jobs)
+
+    def __enter__(self) -> "ImageWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def suffix(self) -> str:
+        return OUTPUT_FORMATS[self.format]
+
+    def path(self, target: PathLike | str) -> Path:
+        """
+        the file a target is written to, with the extension of the format
+
+        :param target: output path, its extension is replaced
+        :return: file path
+        """
+        return Path(target).with_suffix(self.suffix)
+
+    def encode(self, image: Image.Image, fp=None):
+        """
+        encode an image in the format
+
+        :param image: the image
+        :param fp: binary file object, a new buffer if None
+        :return: the file object
+        """
+        if fp is None:
+            fp = io.BytesIO()
+        with stats.stage("image.save", image.width * image.height * len(image.getbands())) as stage:
+            start = fp.tell() if stage else 0
+            if self.format == "raw":
+                write_raw(image, fp)
+            elif self.format == "webp":
+                # exact keeps the color of transparent pixels, so the pixels match the png output
+                image.save(fp, "WEBP", lossless=True, exact=True)
+            elif self.png_level is None:
+                image.save(fp, "PNG")
+            else:
+                image.save(fp, "PNG", compress_level=self.png_level)
+            if stage:
+                stage.bytes_out = fp.tell() - start
+        return fp
+
+    def write(self, image: Image.Image, target: PathLike | str) -> Path:
+        """
+        write an image in the calling thread
+
+        :param image: the image
+        :param target: output path, its extension is replaced by the one of the format
+        :return: the file path
+        """
+        target = self.path(target)
+        # a file linked to another one by dedup is replaced, not written through
+        target.unlink(missing_ok=True)
+        with target.open("wb") as fp:
+            self.encode(image, fp)
+        return target
+
+    def save(self, image: Image.Image, target: PathLike | str) -> Path:
+        """
+        write an image, in the background when the writer has encoding threads
+
+        The image must not be changed afterwards, errors of background writes are raised by `flush`.
+
+        :param image: the image
+        :param target: output path, its extension is replaced by the one of the format
+        :return: the file path
+        """
+        target = self.path(target)
+        if self.jobs <= 0:
+            return self.write(image, target)
+
+        # read lazy images now, their file may be closed by the caller
+        image.load()
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+                # images waiting for a thread, bounds the memory held by the queue
+                self._slots = threading.BoundedSemaphore(self.jobs * 2)
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self.write, image, target)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+        return target
+
+    def flush(self):
+        """
+        wait for the background writes, raise the first error
+
+        :return: None
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        wait for the background writes and stop the encoding threads, the writer can still be used afterwards
+
+        :return: None
+        """
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+@lru_cache(maxsize=None)
+def shared_writer(format: str = "png", png_level: int | None = None, jobs: int = 0) -> ImageWriter:
+    """
+    the writer of these settings shared by the process, its threads run until the process exits
+
+    :return: ImageWriter
+    """
+    return ImageWriter(format, png_level, jobs)
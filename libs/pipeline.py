@@ -0,0 +1,268 @@
+import io
+import queue
+import struct
+import threading
+import zlib
+from os import PathLike
+from pathlib import Path
+
+from PIL import Image
+
+from .dedup import BlobStore
+from .gxt import ZLIB_HEADERS, decode_gxt
+from .lay import LaySprite, render_lay_atlas, render_lay_images
+from .models import MPKFileInfo
+from .output import ImageWriter
+from .mpk import MpkArchive
+from .mvl import render_mvl_images
+
+# members and decoded images held in memory before the reader waits
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+
+_DONE = object()
+
+
+class MemoryBudget:
+    """
+    Byte counter shared by the pipeline stages, only the reader waits on it
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cancelled = False
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int):
+        """
+        wait until `size` bytes fit in the budget, an item larger than the whole budget goes through alone
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.cancelled or self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def cancel(self):
+        """
+        stop waiting, used when a stage failed and will not release its bytes anymore
+        """
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify_all()
+
+    def charge(self, size: int):
+        """
+        count `size` bytes without waiting
+        """
+        with self._condition:
+            self.used += size
+
+    def release(self, size: int):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class _Unit:
+    """
+    A member to decode, together with the members it needs
+    """
+
+    def __init__(self, kind: str, member: MPKFileInfo, source: MPKFileInfo | None = None, write_source=False):
+        self.kind = kind
+        self.member = member
+        self.source = source
+        self.write_source = write_source
+
+    @property
+    def size(self) -> int:
+        return self.member.size + (self.source.size if self.source else 0)
+
+
+def _plan_units(archive: MpkArchive) -> list[_Unit]:
+    # pair "xxx_.lay" and "xxx_.mvl" with their "xxx.png" or "xxx.gxt" tiles
+    claimed: set[str] = set()
+    units = []
+    for file_info in archive:
+        name = file_info.name
+        if not name.endswith(("_.lay", "_.mvl")):
+            continue
+        stem = name[:-5]
+        source = next((stem + suffix for suffix in (".png", ".gxt") if stem + suffix in archive), None)
+        if source is None:
+            continue
+        units.append(_Unit(name[-3:], file_info, archive.getinfo(source), write_source=source not in claimed))
+        claimed.add(source)
+        claimed.add(name)
+
+    units.extend(_Unit("member", file_info) for file_info in archive if file_info.name not in claimed)
+    return units
+
+
+def _magic(data: bytes) -> bytes:
+    if data[:2] in ZLIB_HEADERS:
+        return zlib.decompressobj().decompress(data, 4)
+    return data[:4]
+
+
+def _image_size(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def _decode_member(file_info: MPKFileInfo, data: bytes):
+    target = Path(file_info.name)
+    if _magic(data) == b"GXT\x00":
+        image = decode_gxt(data)
+        return image, (target.with_suffix(".png"), image)
+    # not an asset we convert, keep it as is
+    return None, (target, data)
+
+
+def _decode_unit(unit: _Unit, member_data: bytes, source_data: bytes | None, suffix: str, atlas: bool):
+    if unit.kind == "member":
+        yield _decode_member(unit.member, member_data)[1]
+        return
+
+    # tiles image, written like any other member the first time it is used
+    source_image, output = _decode_member(unit.source, source_data)
+    if unit.write_source:
+        yield output
+    if source_image is None:
+        source_image = Image.open(io.BytesIO(source_data), formats=["PNG"])
+    source_image = source_image.convert("RGBA")
+
+    name = Path(unit.member.name)
+    stem = name.name[:-5]
+    if unit.kind == "lay":
+        folder = name.parent / ("extracted_" + stem)
+        sprite = LaySprite(member_data, source_image)
+        if atlas:
+            images = render_lay_atlas(sprite, suffix)
+        else:
+            images = render_lay_images(sprite, stem + ".png", suffix=suffix)
+        for path, image in images:
+            yield folder / path, image
+    else:
+        folder = name.parent / stem
+        for path, output in render_mvl_images(member_data, source_image, suffix, atlas):
+            yield folder / path, output
+
+
+def _payload_size(payload) -> int:
+    return len(payload) if isinstance(payload, bytes) else _image_size(payload)
+
+
+def unpack_mpk_decoded(
+    file: PathLike | str,
+    unpack_folder: PathLike | str | None = None,
+    jobs: int = 1,
+    memory_limit: int = DEFAULT_MEMORY_LIMIT,
+    store: BlobStore | None = None,
+    writer: ImageWriter | None = None,
+    atlas: bool = False,
+):
+    """
+    unpack mpk file and decode its assets in a single pass, only the final outputs are written
+
+    GXT textures become PNG files, lay and mvl files are rendered with their tiles image, other members are copied.
+    Reading, decoding and saving run at the same time, linked by bounded queues.
+
+    :param file: mpk file path
+    :param unpack_folder: output folder path, defaults to a folder named after the mpk file
+    :param jobs: number of decode and of save threads
+    :param memory_limit: bytes of members and images held in memory before reading waits
+    :param store: when given, outputs with the same content as a file written before are linked to it
+    :param writer: output format of the decoded images, PNG by default, images are encoded by the save threads
+    :param atlas: pack the lay parts and mvl layers into atlas images, lay files get no composed images
+    :return: None
+    """
+    mpk_path = Path(file)
+
+    if unpack_folder:
+        unpack_folder = Path(unpack_folder)
+    else:
+        unpack_folder = mpk_path.parent / mpk_path.stem
+
+    writer = writer or ImageWriter()
+    budget = MemoryBudget(memory_limit)
+    errors: list[Exception] = []
+    decode_queue = queue.Queue(maxsize=jobs * 2)
+    save_queue = queue.Queue(maxsize=jobs * 2)
+
+    def run(function, in_queue: queue.Queue):
+        while (item := in_queue.get()) is not _DONE:
+            # after a failure only drain the queue
+            if errors:
+                continue
+            try:
+                function(*item)
+            except Exception as e:
+                errors.append(e)
+                budget.cancel()
+
+    def queue_output(path: Path, payload):
+        size = _payload_size(payload)
+        budget.charge(size)
+        save_queue.put((path, payload, size))
+
+    def decode(unit: _Unit, member_data: bytes, source_data: bytes | None):
+        try:
+            for path, payload in _decode_unit(unit, member_data, source_data, writer.suffix, atlas):
+                queue_output(path, payload)
+        except (ValueError, AssertionError, SyntaxError, OSError, struct.error, zlib.error) as e:
+            # unsupported or broken asset (mvl checks its format with asserts, PIL raises OSError), keep the members as they are
+            print(f"{unit.member.name}: {e}")
+            queue_output(Path(unit.member.name), member_data)
+            if unit.source and unit.write_source:
+                queue_output(Path(unit.source.name), source_data)
+        finally:
+            budget.release(unit.size)
+
+    def save(path: Path, payload, size: int):
+        try:
+            target = unpack_folder / path
+            if not isinstance(payload, bytes):
+                target = writer.path(target)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if store is not None:
+                if not isinstance(payload, bytes):
+                    # encode first, the content is hashed before anything is written
+                    payload = writer.encode(payload).getbuffer()
+                store.write_bytes(target, payload)
+                return
+
+            # a file linked to another one by dedup is replaced, not written through
+            target.unlink(missing_ok=True)
+            if isinstance(payload, bytes):
+                target.write_bytes(payload)
+            else:
+                writer.write(payload, target)
+        finally:
+            budget.release(size)
+
+    with MpkArchive(mpk_path) as archive:
+        units = _plan_units(archive)
+
+        decoders = [threading.Thread(target=run, args=(decode, decode_queue)) for _ in range(jobs)]
+        savers = [threading.Thread(target=run, args=(save, save_queue)) for _ in range(jobs)]
+        for thread in decoders + savers:
+            thread.start()
+
+        try:
+            for unit in units:
+                if errors:
+                    break
+                budget.acquire(unit.size)
+                source_data = archive.read(unit.source) if unit.source else None
+                decode_queue.put((unit, archive.read(unit.member), source_data))
+        finally:
+            for _ in decoders:
+                decode_queue.put(_DONE)
+            for thread in decoders:
+                thread.join()
+            for _ in savers:
+                save_queue.put(_DONE)
+            for thread in savers:
+                thread.join()
+
+    if errors:
+        raise errors[0]
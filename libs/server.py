@@ -0,0 +1,385 @@
+"""
+Serve the members of mpk archives over HTTP, the images are decoded on request and nothing is written to disk
+
+The URLs follow the folders written by `unpack-mpk --decode`, so view.html works in any sprite folder:
+
+    /                                       archives, JSON
+    /<archive>/                             members, JSON
+    /<archive>/<dir>/a.png                  a.gxt decoded, or the a.png member as it is
+    /<archive>/<dir>/<member>               any member as it is
+    /<archive>/<dir>/extracted_c/index.json layer manifest of c_.lay, with parts/<i>.png and composed/<i>.png
+    /<archive>/<dir>/m/index.json           layers of m_.mvl, with m/<layer>.png
+    .../view.html                           the viewer
+"""
+import hashlib
+import json
+import struct
+import threading
+import traceback
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import PathLike
+from pathlib import Path, PurePosixPath
+from urllib.parse import unquote, urlsplit
+
+from PIL import Image
+
+from . import gxt  # registers the GXT plugin
+from .lay import LaySprite
+from .mpk import MpkArchive
+from .mvl import render_mvl_images
+from .output import ImageWriter
+
+# bytes of encoded responses and lay sprites kept
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# part of the cache size used by the lay sprites, their tiles images and rendered parts, the rest by the responses
+SPRITE_CACHE_SHARE = 0.5
+# bytes of rendered images of one sprite, at most a quarter of the sprite share
+SPRITE_CACHE_SIZE = 64 * 1024 * 1024
+
+VIEWER = Path(__file__).resolve().parent.parent / "view.html"
+
+_CONTENT_TYPES = {".png": "image/png", ".json": "application/json", ".html": "text/html; charset=utf-8"}
+
+
+class _ResponseCache:
+    """
+    Thread-safe LRU cache of response bodies, bounded by their total size
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value: tuple[str, bytes]):
+        size = len(value[1])
+        if size > self.size:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self._bytes -= len(self._items.pop(key)[1])
+            self._items[key] = value
+            self._bytes += size
+            while self._bytes > self.size:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted[1])
+
+
+class AssetServer:
+    """
+    Decode the members of mpk archives by URL path, shared by the request threads
+    """
+
+    def __init__(self, files: list[PathLike | str], cache_size: int = DEFAULT_CACHE_SIZE, png_level: int | None = 1):
+        """
+        :param files: mpk files, served under their stem
+        :param cache_size: bytes of encoded responses and lay sprites to keep, see SPRITE_CACHE_SHARE
+        :param png_level: zlib level of the png responses, fast by default
+        """
+        self.archives: dict[str, MpkArchive] = {}
+        self._versions: dict[str, str] = {}
+        for file in files:
+            archive = MpkArchive(file)
+            stat = archive.path.stat()
+            self.archives[archive.path.stem] = archive
+            self._versions[archive.path.stem] = "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+
+        self.writer = ImageWriter("png", png_level)
+        sprites_size = int(cache_size * SPRITE_CACHE_SHARE)
+        self._cache = _ResponseCache(cache_size - sprites_size)
+        self._sprites: OrderedDict = OrderedDict()
+        # LaySprite.max_bytes of the sprites kept
+        self._sprites_size = sprites_size
+        self._sprites_bytes = 0
+        self._sprites_lock = threading.Lock()
+        # one lock per lay or mvl member, its sprite or layers are built once while the other requests wait
+        self._member_locks: dict[tuple[str, str], threading.Lock] = {}
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+
+    def etag(self, path: str) -> str | None:
+        """
+        validator of a response, computed without decoding anything
+
+        :param path: URL path
+        :return: quoted ETag, None for an unknown archive
+        """
+        name = PurePosixPath(path).parts[1:2]
+        version = self._versions.get(name[0]) if name else ""
+        if version is None:
+            return None
+        digest = hashlib.blake2b("{}\0{}\0{}".format(path, version, self.writer.png_level).encode(), digest_size=8)
+        return '"' + digest.hexdigest() + '"'
+
+    def get(self, path: str) -> tuple[str, bytes]:
+        """
+        response of a URL path
+
+        :param path: URL path, unquoted
+        :return: (content type, body)
+        """
+        parts = PurePosixPath(path).parts[1:]
+        if not parts:
+            return _json([{"name": name, "url": "/" + name + "/"} for name in self.archives])
+
+        archive = self.archives.get(parts[0])
+        if archive is None:
+            raise FileNotFoundError(path)
+        member_path = "/".join(parts[1:])
+        if not member_path:
+            return _json(self._members(parts[0], archive))
+
+        key = (parts[0], member_path)
+        response = self._cache.get(key)
+        if response is None:
+            response = self._render(parts[0], archive, member_path)
+            self._cache.put(key, response)
+        return response
+
+    def _members(self, name: str, archive: MpkArchive) -> list[dict]:
+        members = []
+        for file_info in archive:
+            member = {"index": file_info.index, "name": file_info.name, "size": file_info.size}
+            # where the decoded images and view.html are found
+            stem = PurePosixPath(file_info.name)
+            if file_info.name.endswith("_.lay"):
+                member["view"] = "/{}/{}/view.html".format(name, stem.with_name("extracted_" + stem.name[:-5]))
+            elif file_info.name.endswith("_.mvl"):
+                member["view"] = "/{}/{}/view.html".format(name, stem.with_name(stem.name[:-5]))
+            elif file_info.name.lower().endswith(".gxt"):
+                member["url"] = "/{}/{}".format(name, stem.with_suffix(".png"))
+            members.append(member)
+        return members
+
+    def _render(self, name: str, archive: MpkArchive, member_path: str) -> tuple[str, bytes]:
+        path = PurePosixPath(member_path)
+        if member_path in archive:
+            return _content_type(path), archive.read(member_path)
+        if path.suffix == ".png" and str(path.with_suffix(".gxt")) in archive:
+            with Image.open(archive.open(str(path.with_suffix(".gxt"))), formats=["GXT"]) as image:
+                return "image/png", self._encode(image)
+
+        # sprite folders, the closest one to the file wins
+        for depth in range(len(path.parts) - 1, 0, -1):
+            folder, rest = PurePosixPath(*path.parts[:depth]), PurePosixPath(*path.parts[depth:])
+            if folder.name.startswith("extracted_"):
+                lay_name = str(folder.with_name(folder.name[len("extracted_") :] + "_.lay"))
+                if lay_name in archive:
+                    return self._render_lay(name, archive, lay_name, rest)
+            mvl_name = str(folder.with_name(folder.name + "_.mvl"))
+            if mvl_name in archive:
+                return self._render_mvl(name, archive, mvl_name, folder, rest)
+        raise FileNotFoundError(member_path)
+
+    def _encode(self, image: Image.Image) -> bytes:
+        return self.writer.encode(image).getvalue()
+
+    def _source_image(self, archive: MpkArchive, stem: str) -> Image.Image:
+        # the tiles image of a lay or mvl file, a png or gxt member
+        if stem + ".png" in archive:
+            with Image.open(archive.open(stem + ".png"), formats=["PNG"]) as image:
+                return image.convert("RGBA")
+        if stem + ".gxt" in archive:
+            with Image.open(archive.open(stem + ".gxt"), formats=["GXT"]) as image:
+                return image.convert("RGBA")
+        raise FileNotFoundError(f"cannot find {stem}.png")
+
+    def _member_lock(self, name: str, member_name: str) -> threading.Lock:
+        with self._sprites_lock:
+            return self._member_locks.setdefault((name, member_name), threading.Lock())
+
+    def _sprite(self, name: str, archive: MpkArchive, lay_name: str) -> LaySprite:
+        # called with the member lock held, so the sprite is built once
+        key = (name, lay_name)
+        with self._sprites_lock:
+            sprite = self._sprites.get(key)
+            if sprite is not None:
+                self._sprites.move_to_end(key)
+                return sprite
+
+        cache_size = min(SPRITE_CACHE_SIZE, self._sprites_size // 4)
+        sprite = LaySprite(archive.read(lay_name), self._source_image(archive, lay_name[:-5]), cache_size)
+        with self._sprites_lock:
+            self._sprites[key] = sprite
+            self._sprites_bytes += sprite.max_bytes
+            # the new sprite is kept even when it is larger than the share, it is in use
+            while self._sprites_bytes > self._sprites_size and len(self._sprites) > 1:
+                _, evicted = self._sprites.popitem(last=False)
+                self._sprites_bytes -= evicted.max_bytes
+        return sprite
+
+    def _render_lay(self, name: str, archive: MpkArchive, lay_name: str, rest: PurePosixPath) -> tuple[str, bytes]:
+        # a sprite is not thread-safe, its requests take turns
+        with self._member_lock(name, lay_name):
+            sprite = self._sprite(name, archive, lay_name)
+            if str(rest) == "index.json":
+                return _json(sprite.manifest())
+            if sprite.part_count == 1 and str(rest) == "composed/" + PurePosixPath(lay_name).name[:-5] + ".png":
+                # only one part, it is the composed image
+                image = sprite.part(0)
+            elif len(rest.parts) == 2 and rest.suffix == ".png" and rest.stem.isdigit():
+                index = int(rest.stem)
+                if rest.parts[0] == "parts" and index < sprite.part_count:
+                    image = sprite.part(index)
+                elif rest.parts[0] == "composed" and index < len(sprite.variants):
+                    image = sprite.variant(index, cache=False)
+                else:
+                    raise FileNotFoundError(str(rest))
+            else:
+                raise FileNotFoundError(str(rest))
+        return "image/png", self._encode(image)
+
+    def _render_mvl(
+        self, name: str, archive: MpkArchive, mvl_name: str, folder: PurePosixPath, rest: PurePosixPath
+    ) -> tuple[str, bytes]:
+        # the layers are combined together, all of them are cached for the following requests
+        with self._member_lock(name, mvl_name):
+            # a request waiting for the lock finds the layers rendered by the previous one
+            response = self._cache.get((name, str(folder / rest)))
+            if response is not None:
+                return response
+
+            pic = self._source_image(archive, mvl_name[:-5])
+            for file_name, output in render_mvl_images(archive.read(mvl_name), pic):
+                if isinstance(output, bytes):
+                    content = ("application/json", output)
+                else:
+                    content = ("image/png", self._encode(output))
+                self._cache.put((name, str(folder / file_name)), content)
+                if file_name == str(rest):
+                    response = content
+        if response is None:
+            raise FileNotFoundError(str(rest))
+        return response
+
+
+def _json(data) -> tuple[str, bytes]:
+    return "application/json", json.dumps(data).encode()
+
+
+def _content_type(path: PurePosixPath) -> str:
+    return _CONTENT_TYPES.get(path.suffix.lower(), "application/octet-stream")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "PooledHTTPServer"
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body: bool):
+        path = unquote(urlsplit(self.path).path)
+        assets = self.server.assets
+        if path.endswith("/view.html"):
+            self._send("text/html; charset=utf-8", VIEWER.read_bytes(), None, body)
+            return
+
+        etag = assets.etag(path)
+        if etag is not None and etag in self.headers.get("If-None-Match", ""):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        try:
+            content_type, content = assets.get(path)
+        except (FileNotFoundError, KeyError):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        except (ValueError, AssertionError, SyntaxError, OSError, struct.error, zlib.error) as e:
+            # unsupported or broken asset (mvl checks its format with asserts, PIL raises OSError)
+            self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, str(e))
+            return
+        except Exception as e:
+            # always answer, the traceback goes to the log
+            self.log_error("%s failed: %r", path, e)
+            traceback.print_exc()
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+        self._send(content_type, content, etag, body)
+
+    def _send(self, content_type: str, content: bytes, etag: str | None, body: bool):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            # always revalidate, an unchanged archive answers 304
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server answering the requests on a fixed pool of threads
+    """
+
+    def __init__(self, address: tuple[str, int], assets: AssetServer, jobs: int = 8):
+        super().__init__(address, _Handler)
+        self.assets = assets
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown()
+        self.assets.close()
+
+
+def serve(
+    files: list[PathLike | str],
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    jobs: int = 8,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    png_level: int | None = 1,
+):
+    """
+    serve mpk archives until interrupted
+
+    :param files: mpk files
+    :param host: address to listen on
+    :param port: port to listen on, 0 for any free port
+    :param jobs: number of request threads
+    :param cache_size: bytes of encoded responses and lay sprites to keep
+    :param png_level: zlib level of the png responses
+    :return: None
+    """
+    server = PooledHTTPServer((host, port), AssetServer(files, cache_size, png_level), jobs)
+    print("serving {} archives on http://{}:{}/".format(len(server.assets.archives), *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
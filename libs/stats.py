@@ -0,0 +1,171 @@
+"""
+Per-stage wall time, CPU time, bytes and item counts
+
+Disabled by default, `stage()` then returns a shared object doing nothing, so the calls can stay in the code.
+"""
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # resource is unix only, peak rss is not reported
+    resource = None
+
+enabled = False
+
+_stages: dict[str, dict] = {}
+_lock = threading.Lock()
+
+
+class _NoStage:
+    def __enter__(self) -> "_NoStage":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __bool__(self) -> bool:
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage:
+    __slots__ = ("name", "bytes_in", "bytes_out", "items", "_wall", "_cpu")
+
+    def __init__(self, name: str, bytes_in: int, items: int):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.items = items
+
+    def __enter__(self) -> "_Stage":
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+        add(self.name, wall, cpu, self.bytes_in, self.bytes_out, self.items)
+
+
+def stage(name: str, bytes_in: int = 0, items: int = 1):
+    """
+    time a stage, use as a context manager
+
+    The returned object is false when stats are disabled, set its `bytes_out` only when it is true.
+
+    :param name: stage name, e.g. "gxt.unswizzle"
+    :param bytes_in: bytes read by the stage
+    :param items: number of items done by the stage
+    :return: context manager
+    """
+    if not enabled:
+        return _NO_STAGE
+    return _Stage(name, bytes_in, items)
+
+
+def add(name: str, wall: float = 0.0, cpu: float = 0.0, bytes_in: int = 0, bytes_out: int = 0, items: int = 0):
+    """
+    add measures to a stage
+
+    :return: None
+    """
+    with _lock:
+        totals = _stages.get(name)
+        if totals is None:
+            totals = _stages[name] = {"wall": 0.0, "cpu": 0.0, "bytes_in": 0, "bytes_out": 0, "items": 0}
+        totals["wall"] += wall
+        totals["cpu"] += cpu
+        totals["bytes_in"] += bytes_in
+        totals["bytes_out"] += bytes_out
+        totals["items"] += items
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+def snapshot() -> dict[str, dict]:
+    """
+    copy the stage totals, e.g. to send them from a worker process
+
+    :return: {stage name: {"wall", "cpu", "bytes_in", "bytes_out", "items"}}
+    """
+    with _lock:
+        return {name: dict(totals) for name, totals in _stages.items()}
+
+
+def merge(stages: dict[str, dict]):
+    """
+    add the totals of a snapshot
+
+    :param stages: snapshot of another process
+    :return: None
+    """
+    for name, totals in stages.items():
+        add(name, **totals)
+
+
+def peak_rss() -> dict[str, int] | None:
+    """
+    peak resident set size in bytes of this process and of its finished child processes
+
+    :return: {"self", "children"}, or None without the resource module
+    """
+    if resource is None:
+        return None
+    # linux reports kilobytes, macos bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def report() -> dict:
+    """
+    stage totals with their throughput, and the peak rss
+
+    :return: {"stages": {name: totals}, "peak_rss": ...}
+    """
+    stages = snapshot()
+    for totals in stages.values():
+        wall = totals["wall"]
+        totals["mb_per_s"] = max(totals["bytes_in"], totals["bytes_out"]) / wall / 1e6 if wall else None
+        totals["items_per_s"] = totals["items"] / wall if wall else None
+    return {"stages": stages, "peak_rss": peak_rss()}
+
+
+def format_report(data: dict) -> str:
+    """
+    format a report as a table
+
+    :param data: result of `report()`
+    :return: text
+    """
+    lines = ["{:16} {:>10} {:>10} {:>12} {:>12} {:>8} {:>10}".format("stage", "wall s", "cpu s", "in MB", "out MB", "items", "MB/s")]
+    for name, totals in sorted(data["stages"].items(), key=lambda item: -item[1]["wall"]):
+        lines.append(
+            "{:16} {:10.3f} {:10.3f} {:12.2f} {:12.2f} {:8} {:>10}".format(
+                name,
+                totals["wall"],
+                totals["cpu"],
+                totals["bytes_in"] / 1e6,
+                totals["bytes_out"] / 1e6,
+                totals["items"],
+                "" if totals["mb_per_s"] is None else "{:.1f}".format(totals["mb_per_s"]),
+            )
+        )
+    if data["peak_rss"]:
+        lines.append("peak rss {:.1f} MB, children {:.1f} MB".format(data["peak_rss"]["self"] / 1e6, data["peak_rss"]["children"] / 1e6))
+    return "\n".join(lines)
@@ -1,46 +1,262 @@
+import sys
+
 import libs
 from pathlib import Path
 from argparse import ArgumentParser
+from functools import partial
 
 main_parser = ArgumentParser(description="MAGES Engine helper")
+main_parser.add_argument("--profile", help="Print the time, bytes and items of every stage at the end", action="store_true")
+main_parser.add_argument("--stats-json", help="Write the stage statistics as JSON to this file", type=str)
+main_parser.add_argument("--pstats", help="Write a cProfile dump of the main process to this file", type=str)
 subparsers = main_parser.add_subparsers(title="Sub commands", description="Available sub commands", dest="subcommand")
 
 view_mpk_parser = subparsers.add_parser("view-mpk", help="View mpk file")
 view_mpk_parser.add_argument("input", help="Path to the mpk file", type=str)
 
-unpack_mpk_parser = subparsers.add_parser("unpack-mpk", help="Unpack mpk file")
+# image output options, shared by the commands writing images
+output_parser = ArgumentParser(add_help=False)
+output_parser.add_argument("--format", help="Image file format, raw is an uncompressed dump", choices=["png", "webp", "raw"], default="png")
+output_parser.add_argument("--png-level", help="PNG compression level, 0 (fastest) to 9 (smallest)", type=int, choices=range(10), metavar="0-9")
+output_parser.add_argument("--encode-jobs", help="Number of threads encoding images while decoding goes on", type=int, default=0)
+
+unpack_mpk_parser = subparsers.add_parser("unpack-mpk", help="Unpack mpk file", parents=[output_parser])
 unpack_mpk_parser.add_argument("input", help="Path to the mpk file", type=str)
 unpack_mpk_parser.add_argument("output", help="Path to the unpacked folder", type=str, nargs="?")
+unpack_mpk_parser.add_argument("-j", "--jobs", help="Number of members copied in parallel", type=int, default=1)
+unpack_mpk_parser.add_argument("--decode", help="Decode gxt, lay and mvl members in memory and write images only", action="store_true")
+unpack_mpk_parser.add_argument("--memory-limit", help="Memory used by --decode before reading waits, in MB", type=int, default=512)
+unpack_mpk_parser.add_argument("--force", help="Unpack again even if the mpk file did not change", action="store_true")
+unpack_mpk_parser.add_argument("--atlas", help="With --decode, pack lay parts and mvl layers into atlas images", action="store_true")
+unpack_mpk_parser.add_argument("--dedup", help="Link files with the same content to the first copy instead of writing them again", action="store_true")
+unpack_mpk_parser.add_argument("--dedup-method", help="How --dedup links the files", choices=["hardlink", "reflink"], default="hardlink")
+
+index_parser = subparsers.add_parser("index", help="Build the catalog of all mpk files in a folder")
+index_parser.add_argument("input", help="Path to the game folder", type=str)
+index_parser.add_argument("output", help="Path to the catalog folder", type=str, nargs="?")
+
+query_parser = subparsers.add_parser("query", help="Search the catalog")
+query_parser.add_argument("catalog", help="Path to the catalog file or folder", type=str)
+query_parser.add_argument("pattern", help="Glob on the member names", type=str, nargs="?", default="*")
+query_parser.add_argument("--kind", help="Member kind, e.g. gxt, lay, mvl, png", type=str)
+query_parser.add_argument("--min-width", help="Minimal gxt width", type=int)
+query_parser.add_argument("--min-height", help="Minimal gxt height", type=int)
+query_parser.add_argument("--layer", help="Glob on the mvl layer names", type=str)
 
-extract_lay_parser = subparsers.add_parser("extract-lay", help="Extract lay image")
+serve_parser = subparsers.add_parser("serve", help="Serve the mpk files over HTTP, images are decoded on request")
+serve_parser.add_argument("input", help="Path to the mpk file or the game folder", type=str)
+serve_parser.add_argument("--host", help="Address to listen on", type=str, default="127.0.0.1")
+serve_parser.add_argument("--port", help="Port to listen on", type=int, default=8000)
+serve_parser.add_argument("-j", "--jobs", help="Number of requests answered in parallel", type=int, default=8)
+serve_parser.add_argument("--cache-size", help="Memory used by the responses and lay sprites kept, in MB, half of it for the sprites", type=int, default=256)
+serve_parser.add_argument("--png-level", help="PNG compression level, 0 (fastest) to 9 (smallest)", type=int, choices=range(10), metavar="0-9", default=1)
+
+# options shared by the extract sub commands
+extract_parser = ArgumentParser(add_help=False, parents=[output_parser])
+extract_parser.add_argument("-j", "--jobs", help="Number of files extracted in parallel processes", type=int, default=1)
+extract_parser.add_argument("--force", help="Extract again even if the input files did not change", action="store_true")
+extract_parser.add_argument("--dedup", help="Link output files with the same content to the first copy", action="store_true")
+extract_parser.add_argument("--dedup-method", help="How --dedup links the files", choices=["hardlink", "reflink"], default="hardlink")
+
+extract_lay_parser = subparsers.add_parser("extract-lay", help="Extract lay image", parents=[extract_parser])
 extract_lay_parser.add_argument("input", help="Path to the lay file", type=str)
 extract_lay_parser.add_argument("output", help="Path to the extract images folder", type=str, nargs="?")
+extract_lay_parser.add_argument("--manifest", help="Write the parts and a layer manifest instead of the composed images", action="store_true")
+extract_lay_parser.add_argument("--atlas", help="Like --manifest, with the parts packed into atlas images", action="store_true")
+
+extract_mvl_parser = subparsers.add_parser("extract-mvl", help="Extract mvl image", parents=[extract_parser])
+extract_mvl_parser.add_argument("input", help="Path to the mvl file", type=str)
+extract_mvl_parser.add_argument("output", help="Path to the extract images folder", type=str, nargs="?")
+extract_mvl_parser.add_argument("--atlas", help="Pack the layers into atlas images", action="store_true")
 
-extract_gxt_parser = subparsers.add_parser("extract-gxt", help="Extract gxt image")
+extract_gxt_parser = subparsers.add_parser("extract-gxt", help="Extract gxt image", parents=[extract_parser])
 extract_gxt_parser.add_argument("input", help="Path to the gxt file", type=str)
 extract_gxt_parser.add_argument("output", help="Path to the extract image path/folder", type=str, nargs="?")
 
 
+def _in_worker() -> bool:
+    import multiprocessing
+
+    return multiprocessing.parent_process() is not None
+
+
+def _run_task(function, source: Path, target: Path) -> tuple[str | None, dict | None]:
+    # in a worker process, the stage statistics of the task are sent back with the result
+    worker = libs.stats.enabled and _in_worker()
+    if worker:
+        libs.stats.reset()
+    try:
+        function(source, target)
+        error = None
+    except Exception as e:
+        # a missing, unsupported or broken file (mvl checks its format with asserts), the other files go on
+        error = str(e) or type(e).__name__
+    return error, libs.stats.snapshot() if worker else None
+
+
+def run_tasks(function, tasks: list[tuple[Path, Path]], jobs: int = 1, done=None):
+    """
+    Run `function(source, target)` for every task, in worker processes when `jobs` > 1
+
+    Errors of a file are printed without stopping the other files, a summary is printed at the end.
+
+    :param function: the extract function
+    :param tasks: list of (source, target)
+    :param jobs: number of worker processes
+    :param done: called with the index of every task that succeeded
+    :return: None
+    """
+    if not tasks:
+        return
+
+    sources = [source for source, _ in tasks]
+    targets = [target for _, target in tasks]
+    if jobs > 1:
+        # the heavy modules are imported on use, to keep the start of the light commands fast
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=libs.stats.enable if libs.stats.enabled else None)
+        # a few chunks per worker keeps them busy without one message per file
+        results = executor.map(partial(_run_task, function), sources, targets, chunksize=max(1, len(tasks) // (jobs * 4)))
+    else:
+        executor = None
+        results = map(partial(_run_task, function), sources, targets)
+
+    failed = 0
+    try:
+        for i, (source, (error, stages)) in enumerate(zip(sources, results)):
+            if stages:
+                libs.stats.merge(stages)
+            print(source)
+            if error is not None:
+                print(error)
+                failed += 1
+            elif done:
+                done(i)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    print("{} extracted, {} failed".format(len(tasks) - failed, failed))
+
+
+def image_writer(args) -> "libs.ImageWriter":
+    # one writer for all the tasks, a worker process loads one per process, see ImageWriter.__reduce__
+    return libs.ImageWriter(args.format, args.png_level, args.encode_jobs)
+
+
+def command_key(command: str, args) -> str:
+    # outputs of another format or layout are not up to date
+    if getattr(args, "atlas", False):
+        command += "-atlas"
+    return command if args.format == "png" else command + "-" + args.format
+
+
+def run_incremental(manifest: libs.Manifest, command: str, function, tasks: list[tuple[Path, list[Path], Path]], args):
+    """
+    Run the tasks whose input files changed since they were recorded in the manifest
+
+    :param manifest: manifest of the output folder
+    :param command: sub command name, part of the manifest keys
+    :param function: the extract function
+    :param tasks: list of (source, input files, target)
+    :param args: parsed arguments, for jobs and force
+    :return: None
+    """
+    pending = []
+    for source, inputs, target in tasks:
+        key = manifest.key(command, source)
+        states = manifest.input_states(key, [i for i in inputs if i.exists()])
+        if args.force or not manifest.unchanged(key, target, states):
+            pending.append((source, target, key, states))
+    if len(pending) < len(tasks):
+        print("{} unchanged".format(len(tasks) - len(pending)))
+
+    def done(i: int):
+        _, target, key, states = pending[i]
+        manifest.record(key, target, states)
+
+    try:
+        run_tasks(function, [(source, target) for source, target, _, _ in pending], args.jobs, done)
+    finally:
+        manifest.save()
+
+    if args.dedup:
+        print(libs.dedup_folder(manifest.path.parent, args.dedup_method).report())
+
+
 def main():
     args = main_parser.parse_args()
 
+    if args.profile or args.stats_json:
+        libs.stats.enable()
+    profiler = None
+    if args.pstats:
+        import cProfile
+
+        profiler = cProfile.Profile()
+
+    if profiler:
+        profiler.enable()
+    try:
+        run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.pstats)
+        if libs.stats.enabled:
+            report = libs.stats.report()
+            if args.profile:
+                print(libs.stats.format_report(report), file=sys.stderr)
+            if args.stats_json:
+                import json
+
+                Path(args.stats_json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+def run(args):
+    if not args.subcommand:
+        main_parser.print_help()
+        return
+    if args.subcommand == "query":
+        # print in csv format
+        with libs.Catalog(args.catalog) as catalog:
+            print("MPK, Index, Name, Size, Kind, Width, Height, Parts, Tiles, Layers")
+            for row in catalog.query(args.pattern, args.kind, args.min_width, args.min_height, args.layer):
+                print(
+                    "{}, {}, {}, {}, {}, {}, {}, {}, {}, {}".format(
+                        row["archive"],
+                        row["idx"],
+                        row["name"],
+                        row["size"],
+                        row["kind"],
+                        *("" if row[i] is None else row[i] for i in ("width", "height", "parts", "tiles", "layers")),
+                    )
+                )
+        return
+
     input_files = []
     input_path = Path(args.input)
 
-    if not args.output:
+    # view-mpk only prints and serve only reads, they have no output folder
+    output = getattr(args, "output", None)
+    if not output:
         output_path = Path(input_path.parent) / "cctools"
     else:
-        output_path = Path(args.output)
+        output_path = Path(output)
 
-    output_path.mkdir(parents=True, exist_ok=True)
+    if args.subcommand not in ("view-mpk", "serve"):
+        output_path.mkdir(parents=True, exist_ok=True)
 
     if input_path.is_file():
         input_files.append(input_path)
     elif input_path.is_dir():
-        input_files = list(input_path.glob("*"))
+        input_files = sorted(input_path.glob("*"))
 
-    if not args.subcommand:
-        main_parser.print_help()
+    if args.subcommand == "index":
+        with libs.Catalog(output_path) as catalog:
+            updated, unchanged, removed = catalog.update(input_path)
+        print("{} indexed, {} unchanged, {} removed".format(updated, unchanged, removed))
     elif args.subcommand == "view-mpk":
         # print in csv format
         print("MPK, Index, Name, Size")
@@ -49,39 +265,77 @@ def main():
                 files = libs.get_files_info_in_mpk(f)
                 for i in files:
                     print("{}, {}, {}, {}".format(f, i.index, i.name, i.size))
+    elif args.subcommand == "serve":
+        from libs.server import serve
+
+        files = [f for f in input_files if f.suffix.lower() == ".mpk"]
+        serve(files, args.host, args.port, args.jobs, args.cache_size * 1024 * 1024, args.png_level)
     elif args.subcommand == "unpack-mpk":
+        manifest = libs.Manifest(output_path)
+        command = command_key("unpack-mpk-decoded", args) if args.decode else "unpack-mpk"
+        # shared by all archives, the same file often ships in several of them
+        store = libs.BlobStore(args.dedup_method) if args.dedup else None
         for f in input_files:
             if f.suffix.lower() == ".mpk":
                 print(f)
                 try:
-                    if len(input_files) == 1:
-                        libs.unpack_mpk(f, output_path)
+                    target = output_path if len(input_files) == 1 else output_path / f.stem
+                    key = manifest.key(command, f)
+                    states = manifest.input_states(key, [f])
+                    if not args.force and manifest.unchanged(key, target, states):
+                        print("unchanged")
+                        continue
+
+                    if args.decode:
+                        libs.unpack_mpk_decoded(
+                            f,
+                            target,
+                            jobs=args.jobs,
+                            memory_limit=args.memory_limit * 1024 * 1024,
+                            store=store,
+                            writer=image_writer(args),
+                            atlas=args.atlas,
+                        )
+                        manifest.record(key, target, states)
                     else:
-                        libs.unpack_mpk(f, output_path / f.stem)
+                        # members hashed last time, only the changed ones are written
+                        entry = manifest.get(key) or {}
+                        member_hashes = {} if args.force or entry.get("target") != str(target) else entry.get("members", {})
+                        libs.unpack_mpk(f, target, jobs=args.jobs, member_hashes=member_hashes, store=store)
+                        manifest.record(key, target, states, members=member_hashes)
+                    manifest.save()
                 except ValueError as e:
                     print(e)
+        if store:
+            print(store.report())
     elif args.subcommand == "extract-lay":
+        tasks = []
         for f in input_files:
             if f.suffix.lower() == ".lay":
-                print(f)
-                try:
-                    if len(input_files) == 1:
-                        libs.extract_lay_image(f, output_path)
-                    else:
-                        libs.extract_lay_image(f, output_path / f.stem)
-                except ValueError as e:
-                    print(e)
+                png = f.parent / (f.stem[:-1] + ".png")
+                tasks.append((f, [f, png], output_path if len(input_files) == 1 else output_path / f.stem))
+        command = command_key("extract-lay-manifest" if args.manifest else "extract-lay", args)
+        with image_writer(args) as writer:
+            function = partial(libs.extract_lay_image, manifest=args.manifest, writer=writer, atlas=args.atlas)
+            run_incremental(libs.Manifest(output_path), command, function, tasks, args)
+    elif args.subcommand == "extract-mvl":
+        tasks = []
+        for f in input_files:
+            if f.name.lower().endswith("_.mvl"):
+                inputs = [Path(i) for i in libs.mvl.find_filename(f)]
+                tasks.append((f, inputs, output_path if len(input_files) == 1 else output_path / f.name[:-5]))
+        with image_writer(args) as writer:
+            function = partial(libs.extract_mvl_image, writer=writer, atlas=args.atlas)
+            run_incremental(libs.Manifest(output_path), command_key("extract-mvl", args), function, tasks, args)
     elif args.subcommand == "extract-gxt":
+        writer = image_writer(args)
+        tasks = []
         for f in input_files:
             if f.suffix.lower() == ".gxt":
-                print(f)
-                try:
-                    if len(input_files) == 1:
-                        libs.extract_gxt_image(f, output_path)
-                    else:
-                        libs.extract_gxt_image(f, output_path / (f.stem + ".png"))
-                except ValueError as e:
-                    print(e)
+                tasks.append((f, [f], output_path / (f.stem + writer.suffix)))
+        with writer:
+            function = partial(libs.extract_gxt_image, writer=writer)
+            run_incremental(libs.Manifest(output_path), command_key("extract-gxt", args), function, tasks, args)
 
 
 if __name__ == "__main__":